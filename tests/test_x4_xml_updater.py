@@ -0,0 +1,592 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for x4_xml_updater, each part checked against a reference 
+implementation or a full run.
+
+Run with: python -m pytest tests
+"""
+
+import os
+import re
+import sys
+import time
+import shutil
+import pickle
+import filecmp
+import hashlib
+
+import numpy as np
+import pandas as pd
+import pytest
+from lxml import etree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import x4_xml_updater as x4
+import x4_benchmark
+
+#==============================================================================
+
+@pytest.fixture(autouse=True)
+def closed_catalogs():
+    #.dat memory maps and catalog indexes are cached per path, the tests rewrite archives
+    yield
+    x4.close_catalogs()
+
+def _read_all(catroot):
+    x4.close_catalogs()
+    index = x4.CatalogIndex(catroot)
+    return({path:index.read(path) for path, _ in index.entries.values()})
+
+#------------------------------------------------------------------------------
+
+def test_catalog_round_trip(tmp_path):
+    catroot = str(tmp_path)
+    files = {'assets/props/a_macro.xml': b'<macros />',
+             'assets/props/sub/b_macro.xml': b'',
+             'c.bin': bytes(range(256))}
+
+    counts = x4.write_catalog(catroot, files)
+    assert counts == {'written': 3, 'skipped': 0, 'removed': 0, 'rewritten': True}
+
+    index = x4.CatalogIndex(catroot)
+    for path, data in files.items():
+        entry = index.entry(path)
+        assert index.read(path) == data
+        assert entry.size == len(data)
+        assert entry.md5 == hashlib.md5(data).hexdigest()
+    assert index.listdir('assets/props') == ['a_macro.xml']
+    assert index.read('ASSETS\\Props\\A_Macro.xml') == files['assets/props/a_macro.xml']
+
+    #unchanged entries leave the pair alone
+    assert x4.write_catalog(catroot, files)['rewritten'] is False
+
+    #entries missing from files are carried over only where keep says so
+    counts = x4.write_catalog(catroot, {'assets/props/a_macro.xml': b'<macros/>'}, keep=lambda path: path == 'c.bin')
+    assert counts == {'written': 1, 'skipped': 0, 'removed': 1, 'rewritten': True}
+    assert _read_all(catroot) == {'assets/props/a_macro.xml': b'<macros/>', 'c.bin': files['c.bin']}
+
+    #a pair without entries is deleted
+    x4.write_catalog(catroot, {}, keep=lambda path: False)
+    assert os.listdir(catroot) == []
+
+def test_catalog_interrupted_swap(tmp_path):
+    #new .dat next to the old .cat, as left by a crash between the two replaces
+    catroot = str(tmp_path)
+    catfile = os.path.join(catroot, 'ext_01.cat')
+    keep = lambda path: True
+
+    x4.write_catalog(catroot, {'a.xml': b'AAAA', 'b.xml': b'BBBB'})
+    with open(catfile, 'rb') as infile:
+        old_cat = infile.read()
+
+    #shifted data of the same total size: the carried entry fails its md5 and is dropped
+    x4.write_catalog(catroot, {'a.xml': b'XX', 'c.xml': b'ZZ'}, keep=keep)
+    with open(catfile, 'wb') as outfile:
+        outfile.write(old_cat)
+    x4.write_catalog(catroot, {'a.xml': b'XX', 'c.xml': b'ZZ'}, keep=keep)
+    assert _read_all(catroot) == {'a.xml': b'XX', 'c.xml': b'ZZ'}
+
+    #size mismatch: rebuilt even though every entry matches the old catalog
+    x4.write_catalog(catroot, {'a.xml': b'AAAA', 'b.xml': b'BBBB'})
+    with open(catfile, 'rb') as infile:
+        old_cat = infile.read()
+    x4.write_catalog(catroot, {'a.xml': b'XXXXXXXX'}, keep=keep)
+    with open(catfile, 'wb') as outfile:
+        outfile.write(old_cat)
+    assert x4.write_catalog(catroot, {'a.xml': b'AAAA', 'b.xml': b'BBBB'}, keep=keep)['rewritten'] is True
+    assert _read_all(catroot) == {'a.xml': b'AAAA', 'b.xml': b'BBBB'}
+
+#------------------------------------------------------------------------------
+
+def _parse_asset_file_tree(xmlfile, taglist, convert=True, collapse_diffs=True):
+    #Reference: the original whole-tree parser (first match of every tag and its getpath)
+    xtree = etree.parse(xmlfile)
+    result = {}
+    for attr in taglist:
+        attr_element = xtree.find('.//' + str(attr))
+        if attr_element is None:
+            continue
+        attr_path = xtree.getpath(attr_element)
+        if collapse_diffs:
+            attr_path = re.sub(r'/diff/(replace|add)', '', attr_path)
+        attr_dict = {str(attr_path) + '/' + str(k):v for k, v in attr_element.attrib.items()}
+        if convert:
+            attr_dict = {k:float(v) for k, v in attr_dict.items()}
+        result.update(attr_dict)
+    return(result)
+
+PARSE_CASES = [
+    #same-tag siblings before and after the match
+    '<macros><macro><properties><recharge max="1"/><recharge max="2"/><hull max="3"/></properties></macro></macros>',
+    #the match sits in a later same-tag parent
+    '<macros><macro name="a"><properties><hull max="1"/></properties></macro>'
+    '<macro name="b"><properties><recharge max="2" rate="3"/></properties></macro></macros>',
+    #the same-tag sibling of a parent only shows up after the match
+    '<macros><macro><properties><recharge max="1"/></properties></macro><macro><hull max="2"/></macro></macros>',
+    #single parents, wanted tag missing
+    '<macros><macro><properties><hull max="4"/></properties></macro></macros>',
+    #diff patches, collapsed or not
+    '<diff><replace sel="/macros/macro/properties/recharge"><recharge max="5" rate="6"/></replace>'
+    '<add sel="/macros/macro/properties"><hull max="7"/></add><add sel="/macros/macro"><hull max="8"/></add></diff>',
+    ]
+
+@pytest.mark.parametrize('collapse_diffs', [True, False])
+@pytest.mark.parametrize('case', range(len(PARSE_CASES)))
+def test_parse_asset_file_matches_getpath(tmp_path, case, collapse_diffs):
+    xmlfile = str(tmp_path / 'case_macro.xml')
+    with open(xmlfile, 'w') as outfile:
+        outfile.write(PARSE_CASES[case])
+    taglist = ['recharge', 'hull', 'missing']
+
+    assert (x4.parse_asset_file(xmlfile, taglist, collapse_diffs=collapse_diffs) ==
+            _parse_asset_file_tree(xmlfile, taglist, collapse_diffs=collapse_diffs))
+
+#------------------------------------------------------------------------------
+
+OVERLAY_DOC = ('<macros><macro name="m1" class="shieldgenerator"><properties>'
+               '<recharge max="1" rate="2"/><recharge max="3"/><hull max="4"/></properties></macro>'
+               '<macro name="m2" class="engine"><properties><thrust forward="5"/>'
+               '<recharge rate="6"/></properties><component ref="c"/></macro></macros>')
+
+SELECTORS = [
+    '/macros/macro/properties/recharge',
+    '//recharge',
+    '/macros/macro[@name="m2"]/properties/recharge',
+    "/macros/macro[@name='m1'][@class='shieldgenerator']/properties/hull",
+    '/macros/macro[2]/properties/*',
+    '/macros/macro/properties/recharge[2]',
+    '//properties/recharge[1]',
+    '/macros/macro/properties/recharge/@max',
+    '//recharge/@rate',
+    '//macro[@name="m1"]//hull/@max',
+    '/macros/*/component',
+    '/macros/macro[@name="none"]',
+    '//recharge[@max="3"]',
+    '/properties',
+    ]
+
+@pytest.mark.parametrize('sel', SELECTORS)
+def test_overlay_select_matches_xpath(sel):
+    root = etree.fromstring(OVERLAY_DOC)
+    document = x4.OverlayDocument(root)
+    nodes, attr = document.select(sel)
+
+    tree = etree.ElementTree(root)
+    if '/@' in sel:
+        path, expected_attr = sel.rsplit('/@', 1)
+        expected = [e for e in tree.xpath(path) if expected_attr in e.attrib]
+        assert attr == expected_attr
+        assert len(tree.xpath(sel)) == len(expected)
+    else:
+        expected = tree.xpath(sel)
+        assert attr is None
+    assert [tree.getpath(e) for e in nodes] == [tree.getpath(e) for e in expected]
+
+#------------------------------------------------------------------------------
+
+def _rank_match_merge(df, by, sort, rank, match, suffixes=('_original', '_ranked')):
+    #Reference: the original ranked self merge
+    keys = list(by) if isinstance(by, (list, tuple)) else [by]
+    df = df.sort_values(keys + [sort])
+    df[rank[0]] = df.groupby(keys)[rank[1]].rank(ascending=False, method='first')
+    df[match[0]] = df.groupby(keys)[match[1]].rank(ascending=False, method='first')
+    return(pd.merge(df, df, left_on=keys + [rank[0]], right_on=keys + [match[0]], suffixes=list(suffixes)))
+
+def test_rank_match_matches_self_merge():
+    rng = np.random.default_rng(0)
+
+    def column(n, nan_share, choices=None):
+        if choices is None:
+            values = pd.Series(rng.integers(0, 5, n).astype(float))
+        else:
+            values = pd.Series(rng.choice(choices, n), dtype=object)
+        values[rng.random(n) < nan_share] = np.nan
+        return(values)
+
+    for i in range(300):
+        n = int(rng.integers(1, 30))
+        size = column(n, 0.1 if i % 3 == 0 else 0, ['s', 'm', 'l'])
+        df = pd.DataFrame({'size': size.astype('category') if i % 2 else size,
+                           'scenario': rng.integers(0, 2, n), 'presort': column(n, 0.1),
+                           'a': column(n, 0.2), 'b': column(n, 0.2), 'v': rng.random(n)})
+        by = ['scenario', 'size'] if i % 4 == 0 else 'size'
+
+        expected = _rank_match_merge(df.copy(), by, 'presort', ('rank_a', 'a'), ('rank_b', 'b'))
+        result = x4.rank_match(df.copy(), by, 'presort', ('rank_a', 'a'), ('rank_b', 'b'))
+        if len(expected) == 0:
+            assert len(result) == 0
+            continue
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_categorical=False)
+
+        subset = x4.rank_match(df.copy(), by, 'presort', ('rank_a', 'a'), ('rank_b', 'b'), columns=['v', 'a'])
+        assert list(subset.columns) == [c for c in expected.columns if not c.endswith('_ranked')] + ['v_ranked', 'a_ranked']
+        pd.testing.assert_frame_equal(subset.reset_index(drop=True), expected[subset.columns].reset_index(drop=True),
+                                      check_dtype=False, check_categorical=False)
+
+#------------------------------------------------------------------------------
+
+def _tree_differences(left, right):
+    def walk(cmp):
+        found = cmp.left_only + cmp.right_only + cmp.diff_files
+        for sub in cmp.subdirs.values():
+            found += walk(sub)
+        return(found)
+    return(walk(filecmp.dircmp(left, right)))
+
+def test_watch_poll_matches_full_run(tmp_path):
+    #one race per expansion (FILES_PER_RACE files each)
+    resources, _ = x4_benchmark.generate_tree(str(tmp_path / 'tree'), files=4 * x4_benchmark.FILES_PER_RACE)
+    outdir, sum_outdir = str(tmp_path / 'out'), str(tmp_path / 'summary')
+    os.makedirs(sum_outdir)
+
+    watch = x4.AssetWatch('shields', outdir, resources, sum_outdir, executor='serial', overlay=True)
+    watch.run()
+    assert watch.poll() is None
+
+    #edit, add and remove VRO overlay files
+    macro_dir = str(tmp_path / 'tree' / x4_benchmark.VRO_DIR / 'assets/props/SurfaceElements/macros')
+    macros = sorted(f for f in os.listdir(macro_dir) if f.endswith('_macro.xml'))
+    edited = os.path.join(macro_dir, macros[3])
+    with open(edited, 'r') as infile:
+        text = infile.read()
+    with open(edited, 'w') as outfile:
+        outfile.write(re.sub(r'max="([0-9.]+)"', lambda m: 'max="' + str(float(m.group(1)) * 1.7) + '"', text))
+    shutil.copy(os.path.join(macro_dir, macros[5]), os.path.join(macro_dir, macros[5].replace('_mk', '_new_mk')))
+    os.remove(os.path.join(macro_dir, macros[10]))
+
+    report = watch.poll()
+    assert report is not None and report['files'] > 0
+
+    ref_outdir, ref_sum_outdir = str(tmp_path / 'ref'), str(tmp_path / 'ref_summary')
+    os.makedirs(ref_sum_outdir)
+    modified, modified_cols = x4.AssetRules('shields').run(resources, executor='serial', overlay=True)
+    x4.export_modified(modified, modified_cols, 'shields', resources, ref_outdir, ref_sum_outdir)
+
+    assert _tree_differences(outdir, ref_outdir) == []
+
+def _catalog_contents(modroot):
+    #{catalog directory relative to modroot: {path: bytes}} of every ext_01 pair below modroot
+    contents = {}
+    for dirpath, _, names in os.walk(modroot):
+        if 'ext_01.cat' in names:
+            contents[os.path.relpath(dirpath, modroot)] = _read_all(dirpath)
+    return(contents)
+
+def test_packed_watch_relative_outdir(tmp_path, monkeypatch):
+    resources, _ = x4_benchmark.generate_tree(str(tmp_path / 'tree'), files=4 * x4_benchmark.FILES_PER_RACE)
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('summary')
+
+    watch = x4.AssetWatch('shields', 'out', resources, 'summary', packed=True, executor='serial', overlay=True)
+    watch.run()
+
+    macro_dir = str(tmp_path / 'tree' / x4_benchmark.VRO_DIR / 'assets/props/SurfaceElements/macros')
+    os.remove(os.path.join(macro_dir, sorted(f for f in os.listdir(macro_dir) if f.endswith('_macro.xml'))[10]))
+    assert watch.poll()['removed'] == 1
+
+    os.makedirs('ref_summary')
+    modified, modified_cols = x4.AssetRules('shields').run(resources, executor='serial', overlay=True)
+    x4.export_modified(modified, modified_cols, 'shields', resources, 'ref', 'ref_summary', packed=True)
+
+    assert _catalog_contents('out') == _catalog_contents('ref')
+
+#------------------------------------------------------------------------------
+
+def _pack_tree(resources, asset_path, tree_root, packed_root):
+    #Packs the asset files of every resource root below tree_root into ext_01 archives in 
+    #the same place below packed_root, returns the resources table of the packed roots
+    packed = resources.copy()
+    packed['root'] = resources.root.str.replace(tree_root, packed_root, regex=False)
+
+    for root, catroot in zip(resources.root, packed.root):
+        assetdir = os.path.join(root, asset_path)
+        if not os.path.isdir(assetdir):
+            continue
+        files = {}
+        for name in os.listdir(assetdir):
+            with open(os.path.join(assetdir, name), 'rb') as infile:
+                files[asset_path + '/' + name] = infile.read()
+        x4.write_catalog(catroot, files)
+    return(packed)
+
+def test_archives_match_loose_tree(tmp_path):
+    tree_root = str(tmp_path / 'tree')
+    resources, _ = x4_benchmark.generate_tree(tree_root, files=4 * x4_benchmark.FILES_PER_RACE)
+    asset_path = x4.AssetRules('shields').config['asset_path']
+    packed = _pack_tree(resources, asset_path, tree_root, str(tmp_path / 'packed'))
+
+    loose, loose_cols = x4.update_shields(resources, executor='serial')
+    archived, archived_cols = x4.update_shields(packed, executor='serial', archives=True)
+    assert archived_cols == loose_cols
+
+    #same rows and values, only the roots and the listing order differ
+    def comparable(modified, root):
+        frame = modified.drop(columns=[c for c in modified.columns if c.startswith('asset_id')])
+        for col in frame.columns:
+            if frame[col].dtype == object:
+                frame[col] = frame[col].str.replace(root, '<root>', regex=False)
+        return(frame.sort_values('basefilename_vro').reset_index(drop=True))
+
+    pd.testing.assert_frame_equal(comparable(archived, str(tmp_path / 'packed')), 
+                                  comparable(loose, tree_root), check_dtype=False, check_categorical=False)
+
+def test_packed_watch_snapshot(tmp_path):
+    #glob metacharacters in the root, signature catalogs are not watched
+    root = str(tmp_path / 'game [1.0]')
+    x4.write_catalog(root, {'assets/a_macro.xml': b'<macros/>'})
+    with open(os.path.join(root, 'ext_01_sig.cat'), 'w') as outfile:
+        outfile.write('signature')
+    resources = pd.DataFrame({'root': [root]})
+
+    watch = x4.AssetWatch('shields', 'out', resources, 'summary', archives=True)
+    watch._compile()
+    assert sorted(watch.snapshot()) == [os.path.join(root, 'ext_01.cat'), os.path.join(root, 'ext_01.dat')]
+
+#------------------------------------------------------------------------------
+
+def _parse_resources_baseline(resources, asset_path, file_pattern, taglist):
+    #Reference: the original parse_resources (one row per file, wide xpath columns)
+    loc_resources = resources.copy()
+    loc_resources['assetdir'] = loc_resources.root.apply(lambda x: os.path.join(x, asset_path))
+    loc_resources['filelist'] = loc_resources.assetdir.apply(os.listdir)
+    loc_resources = loc_resources.explode('filelist', ignore_index=True)
+    loc_resources.rename(columns={'filelist':'basefilename'}, inplace=True)
+    loc_resources['keep'] = (loc_resources.basefilename.apply(lambda x: os.path.splitext(x)[1] == '.xml') & 
+                             loc_resources.basefilename.str.contains(file_pattern))
+    loc_resources = loc_resources[loc_resources.keep].reset_index(drop=True).drop('keep', axis=1)
+    loc_resources['fullpath'] = loc_resources.apply(lambda x: os.path.join(x['assetdir'], x['basefilename']), axis=1)
+    parsed = pd.DataFrame(list(loc_resources['fullpath'].apply(lambda x: _parse_asset_file_tree(x, taglist))))
+    return(pd.concat([loc_resources, parsed], axis=1))
+
+def _baseline_frame(resources, asset_path, file_pattern, taglist, prefix):
+    #Reference: parse, name metadata and tag_attrib: xpath map of the original update functions
+    frame = _parse_resources_baseline(resources, asset_path, file_pattern, taglist)
+    metadata = frame.basefilename.str.extract(r'(' + prefix + r')(.*)(_)(s|m|l|xl)(_)(.*)(_.*)(mk.)(.*)', expand=True)
+    metadata = metadata.rename(columns={1:'race', 3:'size', 5:'type', 7:'mk'})
+    frame = pd.concat([frame, metadata[['race', 'size', 'type', 'mk']]], axis=1)
+    cnm_init = {}
+    for tag in taglist:
+        cnm_init.update({str(tag) + '_' + str(c)[str(c).rfind('/') + 1:]:c for c in frame.columns 
+                         if re.match(r'.*(/' + str(tag) + r'/).*', c)})
+    return(frame, cnm_init)
+
+def _join_baseline(frame, cnm_init):
+    modified = pd.merge(frame[frame['source'] == 'vro'].reset_index(), frame[frame['source'] == 'base'].reset_index(), 
+                        how='left', on=['race', 'size', 'type', 'mk'], suffixes=['_vro', '_base'])
+    cnm = dict(cnm_init)
+    cnm.update({str(k) + '_base':str(v) + '_base' for k, v in cnm_init.items()})
+    cnm.update({str(k) + '_vro':str(v) + '_vro' for k, v in cnm_init.items()})
+    return(modified, cnm)
+
+def _group_factor_baseline(modified, keys, num, den, name):
+    factors = modified.groupby(keys).apply(lambda x: (x[num] / x[den]).mean()).reset_index()
+    return(modified.merge(factors.rename(columns={0:name}), how='left', on=keys))
+
+def _update_shields_baseline(resources):
+    #Reference: the original hand written shield balance pass
+    frame, cnm_init = _baseline_frame(resources, 'assets/props/SurfaceElements/macros', r'^shield.*', ['recharge'], 'shield_')
+    modified, cnm = _join_baseline(frame, cnm_init)
+    modified_cols = {}
+
+    modified = _group_factor_baseline(modified, ['size', 'mk'], cnm['recharge_max_vro'], cnm['recharge_max_base'], 'max_factor')
+    modified[cnm['recharge_max']] = modified[cnm['recharge_max_base']] * modified['max_factor']
+    modified.loc[(modified['race'].isin(['kha'])) | (modified[cnm['recharge_max']].isna()), cnm['recharge_max']] = modified[cnm['recharge_max_vro']]
+    modified_cols['recharge_max'] = cnm['recharge_max']
+
+    modified[cnm['recharge_delay']] = modified[cnm['recharge_delay_base']] * (3/2)
+    modified.loc[(modified['race'].isin(['kha'])) | (~modified['size'].isin(['s'])) | (modified[cnm['recharge_delay']].isna()), 
+                 cnm['recharge_delay']] = modified[cnm['recharge_delay_vro']]
+    modified_cols['recharge_delay'] = cnm['recharge_delay']
+
+    modified = _group_factor_baseline(modified, ['size', 'mk'], cnm['recharge_rate_vro'], cnm['recharge_rate_base'], 'recharge_factor')
+    modified[cnm['recharge_rate']] = modified[cnm['recharge_rate_base']] * modified['recharge_factor']
+    modified.loc[modified['size'].isin(['s']), cnm['recharge_rate']] = modified[cnm['recharge_rate_base']] * 0.9
+    modified.loc[modified['size'].isin(['m']), cnm['recharge_rate']] = modified[cnm['recharge_rate_base']] * modified['recharge_factor'] * 1.25
+    modified.loc[(modified['race'].isin(['kha'])) | (modified[cnm['recharge_rate']].isna()), cnm['recharge_rate']] = modified[cnm['recharge_rate_vro']]
+    modified_cols['recharge_rate'] = cnm['recharge_rate']
+
+    return(modified, modified_cols)
+
+def _update_engines_baseline(resources):
+    #Reference: the original hand written engine balance pass
+    frame, cnm_init = _baseline_frame(resources, 'assets/props/Engines/macros', r'^engine.*', ['thrust', 'boost', 'travel'], 'engine_')
+    frame = frame[~frame[cnm_init['travel_thrust']].isna()].reset_index(drop=True)
+    frame['eff_boost_thrust'] = frame[cnm_init['thrust_forward']] * frame[cnm_init['boost_thrust']]
+    frame['eff_travel_thrust'] = frame[cnm_init['thrust_forward']] * frame[cnm_init['travel_thrust']]
+    modified, cnm = _join_baseline(frame, cnm_init)
+    modified_cols = {}
+
+    keys = ['size', 'mk', 'type']
+    modified = _group_factor_baseline(modified, keys, cnm['thrust_forward_vro'], cnm['thrust_forward_base'], 'thrust_factor')
+    modified = _group_factor_baseline(modified, keys, cnm['travel_attack_vro'], cnm['travel_attack_base'], 'attack_factor')
+
+    modified['thrust_forward_pre'] = modified[cnm['thrust_forward_vro']]
+    for kind in ['boost', 'travel']:
+        modified[kind + '_thrust_pre'] = modified['eff_' + kind + '_thrust_base'] / modified['thrust_forward_pre']
+        modified.loc[modified[kind + '_thrust_pre'].isna(), kind + '_thrust_pre'] = (
+            modified['eff_' + kind + '_thrust_vro'] / (modified[cnm['thrust_forward_vro']] / modified['thrust_factor']))
+    modified['eff_boost_thrust_pre'] = modified['thrust_forward_pre'] * modified['boost_thrust_pre']
+    modified['eff_travel_thrust_pre'] = modified['thrust_forward_pre'] * modified['travel_thrust_pre']
+
+    modified = _rank_match_merge(modified, 'size', 'thrust_forward_pre', ('travel_rank', 'eff_travel_thrust_pre'), 
+                                 ('boost_rank', 'eff_boost_thrust_pre'))
+    for suffix in ['_base_original', '_base_ranked', '_vro_original', '_vro_ranked']:
+        cnm.update({str(k) + suffix:str(v) + suffix for k, v in cnm_init.items()})
+
+    modified[cnm['thrust_forward']] = modified[cnm['thrust_forward_vro_original']]
+    modified_cols['thrust_forward'] = cnm['thrust_forward']
+
+    modified[cnm['thrust_reverse']] = modified[cnm['thrust_reverse_base_original']] * modified['thrust_factor_original']
+    modified.loc[modified[cnm['thrust_reverse']].isna(), cnm['thrust_reverse']] = modified[cnm['thrust_reverse_vro_original']]
+    modified_cols['thrust_reverse'] = cnm['thrust_reverse']
+
+    modified['eff_boost_thrust'] = modified['eff_boost_thrust_pre_original']
+    modified[cnm['boost_thrust']] = modified['eff_boost_thrust'] / modified[cnm['thrust_forward']]
+    modified_cols['boost_thrust'] = cnm['boost_thrust']
+
+    def base_or_scaled_vro(tag_attrib):
+        modified[cnm[tag_attrib]] = modified[cnm[tag_attrib + '_base_original']]
+        modified.loc[modified[cnm[tag_attrib]].isna(), cnm[tag_attrib]] = modified[cnm[tag_attrib + '_vro_original']] / modified['attack_factor_original']
+        modified_cols[tag_attrib] = cnm[tag_attrib]
+
+    for tag_attrib in ['boost_duration', 'boost_attack', 'boost_release']:
+        base_or_scaled_vro(tag_attrib)
+
+    large = modified['size'].isin(['l', 'xl'])
+    for races, tag_attrib, factor in [(['par'], 'boost_duration', 2), (['spl'], 'boost_attack', 0.5), (['spl'], 'boost_release', 0.5),
+                                      (['arg', 'tel'], 'boost_duration', 1.33), (['arg', 'tel'], 'boost_attack', 0.75), 
+                                      (['arg', 'tel'], 'boost_release', 0.75)]:
+        modified.loc[modified['race_original'].isin(races) & large, cnm[tag_attrib]] = modified[cnm[tag_attrib]] * factor
+
+    modified['eff_travel_thrust'] = modified['eff_travel_thrust_pre_original']
+    modified.loc[modified['size'].isin(['s', 'm']), 'eff_travel_thrust'] = modified['eff_boost_thrust_pre_ranked']
+    modified.loc[large, 'eff_travel_thrust'] = modified['eff_travel_thrust'] * (5/3)
+    modified[cnm['travel_thrust']] = modified['eff_travel_thrust'] / modified[cnm['thrust_forward']]
+    modified_cols['travel_thrust'] = cnm['travel_thrust']
+
+    for tag_attrib in ['travel_charge', 'travel_attack', 'travel_release']:
+        base_or_scaled_vro(tag_attrib)
+    modified.loc[modified['race_original'].isin(['ter']) & large, cnm['travel_charge']] = modified[cnm['travel_charge']] * 0.75
+
+    return(modified, modified_cols)
+
+RACES = ['arg', 'par', 'tel', 'spl', 'ter', 'kha', 'bor']
+
+def _generate_race_tree(root):
+    #Generated tree with the game's race names, so the race specific rules apply
+    resources, _ = x4_benchmark.generate_tree(root, files=len(RACES) * x4_benchmark.FILES_PER_RACE)
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            renamed = re.sub(r'_r(\d{3})_', lambda m: '_' + RACES[int(m.group(1))] + '_', name)
+            if renamed != name:
+                os.rename(os.path.join(dirpath, name), os.path.join(dirpath, renamed))
+    return(resources)
+
+@pytest.mark.parametrize('asset', ['shields', 'engines'])
+def test_rules_match_baseline(tmp_path, asset):
+    #the rule files reproduce the original balance math, exported values and row order
+    resources = _generate_race_tree(str(tmp_path / 'tree'))
+    baseline = _update_shields_baseline if asset == 'shields' else _update_engines_baseline
+
+    expected, expected_cols = baseline(resources)
+    result, result_cols = x4.AssetRules(asset).run(resources, executor='serial')
+    assert result_cols == expected_cols
+
+    columns = list(expected_cols.values()) + [c for c in ['race', 'size', 'type', 'mk', 'basefilename_vro', 'basefilename_vro_original'] 
+                                              if c in expected.columns]
+    pd.testing.assert_frame_equal(result[columns].reset_index(drop=True), expected[columns].reset_index(drop=True), 
+                                  check_dtype=False, check_categorical=False)
+
+#------------------------------------------------------------------------------
+
+def _engine_rules_with_derive_param():
+    #engine rules whose derive stage (run before the shared join) reads a param
+    config = x4.load_rules('engines')
+    config['params']['boost_scale'] = 1.0
+    config['derive'] = [dict(rule) for rule in config['derive']]
+    for rule in config['derive']:
+        if rule['target'] == 'eff_boost_thrust':
+            rule['expr'] += ' * boost_scale'
+    return(config)
+
+@pytest.mark.parametrize('rules, scenarios', [
+    ('shields', {'base': None, 'slow_delay': {'recharge_delay_factor': 2.0}, 
+                 'fast': {'recharge_rate_factor_s': 1.1, 'recharge_rate_factor_m': 1.5}}),
+    ('engines', {'base': None, 'short': {'travel_thrust_factor_large': 1.2}}),
+    ('engines_derive', {'base': None, 'boosted': {'boost_scale': 1.5}, 'boosted_too': {'boost_scale': 1.5}, 
+                        'both': {'boost_scale': 0.5, 'travel_thrust_factor_large': 1.2}}),
+    ])
+def test_scenarios_match_separate_transforms(tmp_path, rules, scenarios):
+    resources, _ = x4_benchmark.generate_tree(str(tmp_path / 'tree'), files=4 * x4_benchmark.FILES_PER_RACE)
+    asset_rules = x4.AssetRules(_engine_rules_with_derive_param() if rules == 'engines_derive' else rules)
+    store = asset_rules.load(resources, executor='serial')
+
+    variants = asset_rules.transform_scenarios(store, scenarios)
+    assert list(variants) == list(scenarios)
+    for name, params in scenarios.items():
+        expected, expected_cols = asset_rules.transform(store, params=params)
+        modified, modified_cols = variants[name]
+        assert modified_cols == expected_cols
+        pd.testing.assert_frame_equal(modified.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False)
+
+#------------------------------------------------------------------------------
+
+def _write_shield(path, max_value):
+    with open(path, 'w') as outfile:
+        outfile.write('<macros><macro><properties><recharge max="' + str(max_value) + '" rate="2"/>'
+                      '<hull max="3"/></properties></macro></macros>')
+
+def test_parse_cache(tmp_path):
+    filelist = [str(tmp_path / ('shield_' + str(i) + '_macro.xml')) for i in range(6)]
+    for i, path in enumerate(filelist):
+        _write_shield(path, 100 + i)
+    taglist = ['recharge']
+    dbpath = str(tmp_path / 'cache.sqlite')
+    uncached = x4.parse_files(filelist, taglist)
+
+    #cold run parses and stores everything, a warm run (also after reopening) parses nothing
+    cache = x4.ParseCache(dbpath)
+    assert x4.parse_files(filelist, taglist, cache=cache) == uncached
+    assert (cache.hits, cache.misses) == (0, 6)
+    assert x4.parse_files(filelist, taglist, cache=cache) == uncached
+    assert (cache.hits, cache.misses) == (6, 6)
+    cache.close()
+
+    cache = x4.ParseCache(dbpath)
+    assert x4.parse_files(filelist, taglist, cache=cache) == uncached
+    assert (cache.hits, cache.misses) == (6, 0)
+
+    #a changed size or mtime invalidates just that file
+    _write_shield(filelist[1], 10000)
+    info = os.stat(filelist[2])
+    os.utime(filelist[2], ns=(info.st_atime_ns, info.st_mtime_ns + 10**9))
+    results = x4.parse_files(filelist, taglist, cache=cache)
+    assert (cache.hits, cache.misses) == (10, 2)
+    assert results == x4.parse_files(filelist, taglist)
+    assert results[1]['/macros/macro/properties/recharge/max'] == 10000.0
+
+    #another taglist is another variant
+    assert x4.parse_files(filelist, ['recharge', 'hull'], cache=cache) == x4.parse_files(filelist, ['recharge', 'hull'])
+    assert (cache.hits, cache.misses) == (10, 8)
+    cache.close()
+
+def test_parse_cache_evicts_least_recently_used(tmp_path):
+    filelist = [str(tmp_path / ('shield_' + str(i) + '_macro.xml')) for i in range(3)]
+    for i, path in enumerate(filelist):
+        _write_shield(path, 100 + i)
+    taglist = ['recharge']
+    variant = x4.ParseCache.variant(taglist)
+    entry_bytes = len(pickle.dumps(x4.parse_asset_file(filelist[0], taglist), protocol=pickle.HIGHEST_PROTOCOL))
+
+    #room for two entries: the one not used since is evicted by the third
+    cache = x4.ParseCache(str(tmp_path / 'cache.sqlite'), max_bytes=int(2.5 * entry_bytes))
+    x4.parse_files(filelist[:2], taglist, cache=cache)
+    time.sleep(0.01)
+    cache.lookup(filelist[:1], variant)
+    time.sleep(0.01)
+    x4.parse_files(filelist[2:], taglist, cache=cache)
+
+    results, _ = cache.lookup(filelist, variant)
+    assert [r is not None for r in results] == [True, False, True]
+    cache.close()
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark harness for x4_xml_updater
+
+Generates a synthetic extracted X4:Foundations tree (base game, expansions and VRO
+overlays) and times the parse, transform and export stages separately.  Results are
+stored as JSON so runs can be compared across commits.
+
+    python x4_benchmark.py --files 20000 --out bench_20k.json
+    python x4_benchmark.py --files 20000 --compare bench_20k.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+
+import pandas as pd
+
+import x4_xml_updater as x4
+
+#==============================================================================
+
+#expansion: directory relative to the base root ('' for the base game itself)
+EXPANSIONS = {'base': '',
+              'split': 'extensions/ego_dlc_split',
+              'terran': 'extensions/ego_dlc_terran',
+              'boron': 'extensions/ego_dlc_boron'}
+
+VRO_DIR = 'extensions/vro'
+
+SIZES = ['s', 'm', 'l', 'xl']
+MKS = ['mk1', 'mk2', 'mk3']
+ENGINE_TYPES = ['allround', 'combat', 'travel']
+SHIELD_TYPES = ['standard', 'heavy']
+
+#files written per race: engines + shields, base/expansion file plus VRO overlay
+FILES_PER_RACE = 2 * len(SIZES) * len(MKS) * (len(ENGINE_TYPES) + len(SHIELD_TYPES))
+
+#------------------------------------------------------------------------------
+
+def _engine_xml(name, rng, scale, thruster=False):
+    props = ['      <thrust forward="{:.2f}" reverse="{:.2f}" />'.format(rng.uniform(100, 1000) * scale,
+                                                                         rng.uniform(100, 800) * scale)]
+    if not thruster:
+        props.append('      <boost duration="{:.2f}" thrust="{:.2f}" attack="{:.2f}" release="{:.2f}" />'.format(
+            rng.uniform(1, 20), rng.uniform(2, 8), rng.uniform(0.1, 2), rng.uniform(0.1, 2)))
+        props.append('      <travel charge="{:.2f}" thrust="{:.2f}" attack="{:.2f}" release="{:.2f}" />'.format(
+            rng.uniform(1, 20), rng.uniform(5, 30), rng.uniform(1, 60), rng.uniform(0.1, 2)))
+    return(name, 'engine', props)
+
+def _shield_xml(name, rng, scale):
+    props = ['      <recharge max="{:.2f}" rate="{:.2f}" delay="{:.2f}" />'.format(
+        rng.uniform(100, 10000) * scale, rng.uniform(10, 500) * scale, rng.uniform(0.1, 5))]
+    return(name, 'shieldgenerator', props)
+
+def _render_macro(name, macro_class, props, diff=False):
+    #Full macro file, or a <diff> patch replacing the whole /macros element
+    #(which parse_asset_file collapses back onto the same xpaths)
+
+    macro = ['<macros>',
+             '  <macro name="' + name + '_macro" class="' + macro_class + '">',
+             '    <component ref="' + name + '" />',
+             '    <properties>',
+             '      <identification name="' + name + '" />']
+    macro += props
+    macro += ['    </properties>', '  </macro>', '</macros>']
+
+    if diff:
+        macro = ['<diff>', '  <replace sel="/macros">'] + ['    ' + line for line in macro] + ['  </replace>', '</diff>']
+
+    return('\n'.join(['<?xml version="1.0" encoding="utf-8"?>'] + macro) + '\n')
+
+#------------------------------------------------------------------------------
+
+def generate_tree(root, files=2000, diff_fraction=0.1, missing_fraction=0.1, seed=1):
+    #Writes a synthetic extracted tree
+    #
+    #root: output directory (the base game root)
+    #files: approximate number of macro files to write
+    #diff_fraction: share of expansion/VRO files written as <diff> patches
+    #missing_fraction: share of VRO assets without a base game counterpart
+    #seed: random seed, the same inputs always give the same tree
+    #
+    #Races are spread over the expansions; every asset gets a VRO overlay with scaled stats.
+    #A few thrusters (engines without travel stats) and non-xml files are mixed in to
+    #exercise the filters.  Returns the resources table for the tree.
+
+    rng = random.Random(seed)
+    nraces = max(1, int(round(files / float(FILES_PER_RACE))))
+    expansions = list(EXPANSIONS)
+
+    written = 0
+    for r in range(nraces):
+        race = 'r' + str(r).zfill(3)
+        expansion = expansions[r % len(expansions)]
+
+        for kind, asset_path, types in [('engine', 'assets/props/Engines/macros', ENGINE_TYPES),
+                                        ('shield', 'assets/props/SurfaceElements/macros', SHIELD_TYPES)]:
+            base_dir = os.path.join(root, EXPANSIONS[expansion], asset_path)
+            vro_dir = os.path.join(root, VRO_DIR, EXPANSIONS[expansion], asset_path)
+
+            for size in SIZES:
+                for asset_type in types:
+                    for mk in MKS:
+                        name = '_'.join([kind, race, size, asset_type, '01', mk])
+                        in_base = rng.random() >= missing_fraction
+
+                        for outdir, scale, present in [(base_dir, 1.0, in_base), (vro_dir, 1.3, True)]:
+                            if not present:
+                                continue
+                            thruster = kind == 'engine' and asset_type == 'travel' and size == 's' and mk == 'mk3'
+                            if kind == 'engine':
+                                spec = _engine_xml(name, rng, scale, thruster=thruster)
+                            else:
+                                spec = _shield_xml(name, rng, scale)
+                            diff = (outdir == vro_dir or expansion != 'base') and rng.random() < diff_fraction
+
+                            os.makedirs(outdir, exist_ok=True)
+                            with open(os.path.join(outdir, name + '_macro.xml'), 'w') as outfile:
+                                outfile.write(_render_macro(*spec, diff=diff))
+                            written += 1
+
+    #noise the file filters have to skip
+    for expansion in expansions:
+        for asset_path in ['assets/props/Engines/macros', 'assets/props/SurfaceElements/macros']:
+            outdir = os.path.join(root, EXPANSIONS[expansion], asset_path)
+            os.makedirs(outdir, exist_ok=True)
+            with open(os.path.join(outdir, 'readme.txt'), 'w') as outfile:
+                outfile.write('not an asset')
+
+    roots = {name:os.path.join(root, path) for name, path in EXPANSIONS.items()}
+    roots['vro_base'] = os.path.join(root, VRO_DIR)
+
+    return(x4.build_resources(roots), written)
+
+#------------------------------------------------------------------------------
+
+def _timed(results, stage, func, trace=False):
+    #Runs func and records wall time, peak RSS growth and (with trace) the tracemalloc peak
+    #
+    #The RSS high-water mark never goes down, so like RunReport the stage records how far it
+    #rose during the stage (0 when an earlier stage already peaked higher).
+
+    if trace:
+        tracemalloc.start()
+    rss = x4._peak_rss_mb()
+    start = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter() - start
+
+    peak = x4._peak_rss_mb()
+    record = {'seconds': round(elapsed, 4), 'peak_rss_delta_mb': round(peak - rss, 2) if peak is not None else None}
+    if trace:
+        record['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0), 2)
+        tracemalloc.stop()
+    results[stage] = record
+
+    print('{:<28} {:>9.3f} s'.format(stage, elapsed))
+    return(value)
+
+#------------------------------------------------------------------------------
+
+def run_benchmark(tree, files, assets=('shields', 'engines'), parse_kwargs=None, trace=False, seed=1, keep=False):
+    #Generates (or reuses) a tree and times every pipeline stage per asset class
+    #
+    #tree: directory for the synthetic tree, reused when it was generated with the same inputs
+    #files: approximate number of macro files
+    #assets: rule configs to run
+    #parse_kwargs: passed through to load_attribute_store
+    #trace: also record tracemalloc peaks (slows the stages down)
+    #keep: keep the diff output directory
+
+    parse_kwargs = dict(parse_kwargs or {})
+    stages = {}
+
+    marker = os.path.join(tree, 'x4_benchmark_tree.json')
+    tree_spec = {'files': files, 'seed': seed, 'files_per_race': FILES_PER_RACE}
+    reuse = False
+    if os.path.exists(marker):
+        with open(marker, 'r') as infile:
+            reuse = json.load(infile) == tree_spec
+    if reuse:
+        roots = {name:os.path.join(tree, path) for name, path in EXPANSIONS.items()}
+        roots['vro_base'] = os.path.join(tree, VRO_DIR)
+        resources = x4.build_resources(roots)
+        stages['generate'] = {'seconds': None, 'reused': True}
+    else:
+        if os.path.exists(marker):
+            shutil.rmtree(tree)
+        elif os.path.isdir(tree) and os.listdir(tree):
+            raise ValueError('Refusing to generate a benchmark tree into non-empty directory: ' + str(tree))
+        resources, written = _timed(stages, 'generate', lambda: generate_tree(tree, files=files, seed=seed))
+        stages['generate']['files'] = written
+        with open(marker, 'w') as outfile:
+            json.dump(tree_spec, outfile)
+
+    outdir = tempfile.mkdtemp(prefix='x4_bench_out_')
+    try:
+        for name in assets:
+            asset_rules = x4.AssetRules(name)
+            store = _timed(stages, name + '.parse', lambda: asset_rules.load(resources, **parse_kwargs), trace)
+            stages[name + '.parse']['files'] = len(store)
+
+            modified, modified_cols = _timed(stages, name + '.transform', lambda: asset_rules.transform(store), trace)
+            stages[name + '.transform']['rows'] = len(modified)
+
+            source_col = 'fullpath_vro_original' if 'fullpath_vro_original' in modified.columns else 'fullpath_vro'
+            modified['fullpath_final'] = modified[source_col].str.replace(resources.loc[resources.resource == 'vro_base', 'root'].values[0],
+                                                                          os.path.join(outdir, name), regex=False)
+            diffs = x4.AttributeStore.from_frame(modified, modified_cols, meta=['fullpath_final'])
+            manifest = os.path.join(outdir, name + '_manifest.json')
+
+            for run in ['export_cold', 'export_warm']:
+                report = _timed(stages, name + '.' + run,
+                                lambda: x4.export_asset_diffs(diffs, path_col='fullpath_final', manifest=manifest), trace)
+                stages[name + '.' + run].update(report)
+    finally:
+        if not keep:
+            shutil.rmtree(outdir, ignore_errors=True)
+
+    return(stages)
+
+#------------------------------------------------------------------------------
+
+def _git_commit():
+    try:
+        return(subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip())
+    except (OSError, subprocess.CalledProcessError):
+        return(None)
+
+def compare(results, baseline):
+    #Prints stage times of results against a previous result file
+
+    print('\n{:<28} {:>10} {:>10} {:>8}'.format('stage', 'baseline', 'current', 'ratio'))
+    for stage, record in results['stages'].items():
+        old = baseline['stages'].get(stage, {}).get('seconds')
+        new = record.get('seconds')
+        if old and new:
+            print('{:<28} {:>10.3f} {:>10.3f} {:>7.2f}x'.format(stage, old, new, new / old))
+
+#------------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark x4_xml_updater on a synthetic asset tree.')
+    parser.add_argument('--files', type=int, default=2000, help='approximate number of macro files')
+    parser.add_argument('--tree', help='tree directory (default: a temporary directory, removed afterwards)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--assets', nargs='+', default=['shields', 'engines'])
+    parser.add_argument('--executor', default='serial', choices=['serial', 'thread', 'process'])
+    parser.add_argument('--max-workers', type=int)
+    parser.add_argument('--chunksize', type=int, default=16)
+    parser.add_argument('--cache', help='parse cache database (warm runs skip XML parsing)')
+    parser.add_argument('--tracemalloc', action='store_true', help='record python allocation peaks per stage')
+    parser.add_argument('--out', help='write the results as JSON')
+    parser.add_argument('--compare', help='previous results JSON to compare against')
+    args = parser.parse_args(argv)
+
+    parse_kwargs = {'executor': args.executor, 'max_workers': args.max_workers, 'chunksize': args.chunksize}
+    if args.cache:
+        parse_kwargs['cache'] = args.cache
+
+    tree = args.tree or tempfile.mkdtemp(prefix='x4_bench_tree_')
+    try:
+        stages = run_benchmark(tree, args.files, assets=args.assets, parse_kwargs=parse_kwargs,
+                               trace=args.tracemalloc, seed=args.seed)
+    finally:
+        if not args.tree:
+            shutil.rmtree(tree, ignore_errors=True)
+
+    results = {'commit': _git_commit(),
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'params': {'files': args.files, 'seed': args.seed, 'assets': args.assets,
+                          'executor': args.executor, 'max_workers': args.max_workers,
+                          'chunksize': args.chunksize, 'cache': bool(args.cache), 'tracemalloc': args.tracemalloc},
+               'platform': {'python': platform.python_version(), 'pandas': pd.__version__,
+                            'system': platform.platform(), 'cpus': os.cpu_count()},
+               'stages': stages}
+
+    if args.out:
+        with open(args.out, 'w') as outfile:
+            json.dump(results, outfile, indent=1)
+    if args.compare:
+        with open(args.compare, 'r') as infile:
+            compare(results, json.load(infile))
+
+    return(0)
+
+#==============================================================================
+
+if __name__ == "__main__":
+    sys.exit(main())
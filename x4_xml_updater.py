@@ -7,43 +7,265 @@ Created on Thu Mar 11 22:14:51 2021
 
 import os
 import re
+import sys
+import io
+import ast
 import copy
+import glob
+import json
+import mmap
+import time
+import pickle
+import sqlite3
+import cProfile
+import pstats
+import hashlib
+import argparse
+import functools
+import contextlib
+import collections
+import tracemalloc
+import numpy as np
 import pandas as pd
-import tkinter as tk
 
-import plotly.io as pio
-import plotly.express as px
-
-from tkinter import filedialog
 from lxml import etree
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError: #Windows
+    resource = None
 
 #==============================================================================
 
+def _peak_rss_mb():
+    #Process high-water mark of the resident set size in MB (None where unavailable)
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #kilobytes on Linux, bytes on macOS
+        return(peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0)
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return(getattr(info, 'peak_wset', info.rss) / (1024.0 * 1024.0))
+    except ImportError:
+        return(None)
+
+#------------------------------------------------------------------------------
+
+def _cpu_seconds():
+    #CPU time of this process plus its finished child processes (e.g. process pool workers)
+    times = os.times()
+    return(times.user + times.system + times.children_user + times.children_system)
+
+#------------------------------------------------------------------------------
+
+class RunReport(object):
+    #Per stage timing and memory figures of a pipeline run
+    #
+    #deep: also run cProfile over the whole run and record tracemalloc peaks per stage
+    #
+    #Stages nest: a stage opened inside another is recorded as 'outer/inner'.  Each record 
+    #holds wall and CPU seconds, the growth of the process peak RSS and any counts (files, 
+    #rows, ...) the stage adds to the dict it yields.
+
+    def __init__(self, deep=False):
+        self.deep = deep
+        self.stages = []
+        self.open = []
+        self.profile = None
+        self.started = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name, **counts):
+        record = {'stage': (self.open[-1]['stage'] + '/' if self.open else '') + str(name)}
+        record.update(counts)
+        self.stages.append(record)
+
+        if self.deep:
+            self._flush_traced_peak()
+        self.open.append(record)
+        rss, cpu, wall = _peak_rss_mb(), _cpu_seconds(), time.perf_counter()
+        try:
+            yield(record)
+        finally:
+            record['wall_s'] = round(time.perf_counter() - wall, 4)
+            record['cpu_s'] = round(_cpu_seconds() - cpu, 4)
+            peak = _peak_rss_mb()
+            record['peak_rss_delta_mb'] = round(peak - rss, 2) if peak is not None else None
+            if self.deep:
+                self._flush_traced_peak()
+            self.open.pop()
+
+    def _flush_traced_peak(self):
+        #Folds the tracemalloc peak since the last flush into every open stage
+        peak = round(tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0), 2)
+        for record in self.open:
+            record['traced_peak_mb'] = max(record.get('traced_peak_mb', 0), peak)
+        tracemalloc.reset_peak()
+
+    def start(self):
+        if self.deep:
+            tracemalloc.start()
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return(self)
+
+    def stop(self):
+        if self.deep and self.profile is not None:
+            self.profile.disable()
+            tracemalloc.stop()
+        return(self)
+
+    def to_dict(self, top=25):
+        result = {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                  'deep': self.deep,
+                  'stages': self.stages}
+        if self.profile is not None:
+            stats = pstats.Stats(self.profile)
+            rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+            result['profile_top'] = [{'function': '{}:{}({})'.format(*func), 'calls': calls, 
+                                      'tottime_s': round(tottime, 4), 'cumtime_s': round(cumtime, 4)}
+                                     for func, (cc, calls, tottime, cumtime, callers) in rows]
+        return(result)
+
+    def write(self, path):
+        #Writes the machine readable report (and the raw cProfile stats next to it in deep mode)
+        if self.profile is not None:
+            self.profile.dump_stats(os.path.splitext(path)[0] + '.prof')
+        with open(path, 'w') as outfile:
+            json.dump(self.to_dict(), outfile, indent=1)
+
+    def summary(self):
+        #Short console table of the stages
+        lines = ['{:<40} {:>9} {:>9} {:>10}  {}'.format('stage', 'wall s', 'cpu s', 'rss +MB', 'counts')]
+        for record in self.stages:
+            counts = ', '.join(str(k) + '=' + str(v) for k, v in record.items() 
+                               if k not in ['stage', 'wall_s', 'cpu_s', 'peak_rss_delta_mb', 'traced_peak_mb'])
+            rss = record.get('peak_rss_delta_mb')
+            lines.append('{:<40} {:>9.3f} {:>9.3f} {:>10}  {}'.format(record['stage'], record.get('wall_s', 0), 
+                                                                    record.get('cpu_s', 0), 
+                                                                    '-' if rss is None else round(rss, 1), counts))
+        return('\n'.join(lines))
+
+_active_reports = []
+
+@contextlib.contextmanager
+def stage(name, **counts):
+    #Records a pipeline stage into the active RunReport (see run_pipeline), if there is one
+    if _active_reports:
+        with _active_reports[-1].stage(name, **counts) as record:
+            yield(record)
+    else:
+        yield(dict(counts))
+
+#------------------------------------------------------------------------------
+
+@contextlib.contextmanager
+def recording(report):
+    #Makes report the active RunReport for the stages run inside the block
+    _active_reports.append(report.start())
+    try:
+        yield(report)
+    finally:
+        _active_reports.pop()
+        report.stop()
+
+#------------------------------------------------------------------------------
+
+class _PathStep(object):
+    #One open element on the streaming parser stack
+    #
+    #tag: element tag
+    #index: 1-based position among same-tag siblings seen so far
+    #multi: True/False once it is known whether the parent holds other same-tag children
+    #       (lxml getpath only adds '[index]' in that case), None while still unknown
+
+    __slots__ = ('tag', 'index', 'multi', 'children')
+
+    def __init__(self, tag, index=1, multi=None):
+        self.tag = tag
+        self.index = index
+        self.multi = multi
+        self.children = {}
+
+    def __str__(self):
+        return(self.tag + ('[' + str(self.index) + ']' if self.multi else ''))
+
+#------------------------------------------------------------------------------
+
 def parse_asset_file(xmlfile, taglist, convert=True, collapse_diffs=True):
     #Parses X4:Foundations asset xml files
     #
-    #xmlfile: file path to desired input asset file
+    #xmlfile: file path, CatalogEntry or binary file object of the desired input asset file
     #taglist: XML asset property tag to collect attributes for
     #convert: If True attributes will be converted to floats
+    #collapse_diffs: If True /diff/replace and /diff/add are stripped from the xpath
+    #
+    #The file is read once with iterparse, collecting the first element below the
+    #document root for every tag (same match as xtree.find('//' + tag)).  Reading stops
+    #as soon as all tags are found and their xpaths are fully determined, and finished
+    #elements are freed as we go.
+
+    wanted = set(str(tag) for tag in taglist)
+    found = {}
+    pending = set()
+    stack = []
 
-    xtree = etree.parse(xmlfile)
+    if isinstance(xmlfile, CatalogEntry):
+        infile = io.BytesIO(read_catalog_entry(xmlfile))
+    elif isinstance(xmlfile, (str, bytes, os.PathLike)):
+        infile = open(xmlfile, 'rb')
+    else:
+        infile = xmlfile
+
+    try:
+        for event, elem in etree.iterparse(infile, events=('start', 'end')):
+            if event == 'start':
+                if stack:
+                    siblings = stack[-1].children
+                    prev = siblings.get(elem.tag)
+                    if prev is None:
+                        step = _PathStep(elem.tag)
+                    else:
+                        step = _PathStep(elem.tag, index=prev.index + 1, multi=True)
+                        prev.multi = True
+                        pending.discard(prev)
+                    siblings[elem.tag] = step
+                else:
+                    step = _PathStep(elem.tag, multi=False)
+                stack.append(step)
+
+                if len(stack) > 1 and elem.tag in wanted and elem.tag not in found:
+                    found[elem.tag] = (list(stack), dict(elem.attrib))
+                    pending.update(s for s in stack if s.multi is None)
+            else:
+                #siblings that never got a same-tag follower keep their bare tag
+                for child in stack.pop().children.values():
+                    if child.multi is None:
+                        child.multi = False
+                        pending.discard(child)
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+            if len(found) == len(wanted) and not pending:
+                break
+    finally:
+        if infile is not xmlfile:
+            infile.close()
 
     result = {}
     for attr in taglist:
         
-        attr_element = xtree.find('//' + str(attr))
-        
-        if attr_element is not None:
-            attr_path = xtree.getpath(attr_element)
-            
+        if str(attr) in found:
+            steps, attrib = found[str(attr)]
+            attr_path = '/' + '/'.join(str(s) for s in steps)
             
             if collapse_diffs:
                 attr_path = re.sub(r'/diff/(replace|add)', '', attr_path)
             
-            if attr_element is None: 
-                attr_dict = {} 
-            else: 
-                attr_dict = {str(attr_path) + '/' +  str(k):v for k,v in attr_element.attrib.items()}
+            attr_dict = {str(attr_path) + '/' +  str(k):v for k,v in attrib.items()}
             
             if convert:
                 attr_dict = {k:float(v) for k,v in attr_dict.items()}
@@ -56,371 +278,2340 @@ def parse_asset_file(xmlfile, taglist, convert=True, collapse_diffs=True):
 
 #------------------------------------------------------------------------------
 
+def render_asset_xml_diff(attributes):
+    #Renders the text of an X4:Foundations asset diff xml file
+    #
+    #attributes: dict (or list of pairs) of xpath:value to be exported in the diff file
+
+    if isinstance(attributes, dict):
+        attributes = attributes.items()
+
+    lines = ['<?xml version="1.0" encoding="utf-8"?>', '<diff>']
+    for xpath, val in attributes:
+        xpath = str(xpath)
+        split = xpath.rfind('/') + 1
+        lines.append('  <replace sel="' + xpath[:split] + '@' + xpath[split:] + '">' + str(round(val,2)) + '</replace>')
+    lines.append('</diff>')
+
+    return('\n'.join(lines))
+
+#------------------------------------------------------------------------------
+
+def _write_atomic(outfilepath, text):
+    #Writes text to a temporary file next to outfilepath and moves it into place
+
+    tmppath = outfilepath + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(tmppath, 'w') as outfile:
+            outfile.write(text)
+        os.replace(tmppath, outfilepath)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+#------------------------------------------------------------------------------
+
 def export_asset_xml_diff(outfilepath, attributes):
     #Exports X4:Foundations asset diff xml files
     #
     #outfilepath: file path to desired output file
     #attributes: dict of xpath:value to be exported in the diff file
 
-    attributes
-
-    outstr = '\n'.join(['<?xml version="1.0" encoding="utf-8"?>',
-                        '<diff>',
-                        '  <replace sel="' + 
-                          '\n  <replace sel="'.join([str(xpath)[:str(xpath).rfind('/') + 1] + '@' + 
-                                                     str(xpath)[str(xpath).rfind('/') + 1:] + '">' + 
-                                                     str(round(val,2)) + '</replace>' 
-                                                     for xpath,val in attributes.items()]),
-                        '</diff>'])
-    
     os.makedirs(os.path.dirname(outfilepath), exist_ok=True)
-    
-    with open(outfilepath, 'w') as outfile:
-        outfile.write(outstr)
+    _write_atomic(outfilepath, render_asset_xml_diff(attributes))
         
     return(True)
 
 #------------------------------------------------------------------------------
 
-def parse_resources(resources, asset_path, file_pattern, taglist):
-    #Collects and parses relevant X4:Foundations asset files based upon input filters
+def export_asset_diffs(store, path_col, manifest=None, scope=None, packed=None, modroot=None):
+    #Exports one X4:Foundations asset diff xml file per asset of an AttributeStore, incrementally
     #
-    #resources: pd.DataFrame of available unpacked input directories, contains resources root
-    #asset_path: path to relevant directory for the specific asset, relative to resource root
-    #file_pattern: regex pattern to id files in asset path to retain
-    #taglist: tags to extract from the identied input files
+    #store: AttributeStore of the values to write (e.g. AttributeStore.from_frame of a transform result)
+    #path_col: asset table column holding each output file path
+    #manifest: optional JSON file of path: content hash from the previous export, updated in place.
+    #          Without it, unchanged files are detected by reading the existing file.
+    #scope: optional output paths of the previous export that store replaces (partial update), 
+    #       files outside it are neither removed nor dropped from the manifest
+    #packed: optional mod root directory, the diffs (all below it) are then packed into 
+    #        ext_01.cat/.dat archives instead of written as loose files, see write_catalog
+    #modroot: optional mod root directory of loose output, the entries this export owns are
+    #         dropped from its archives (left over from a packed export)
+    #
+    #Only diffs whose content changed are (atomically) written and each output directory is 
+    #created once.  Files listed in the manifest that are no longer produced (their source
+    #asset disappeared) are deleted.
+    #Returns a dict with the number of files written, skipped and removed.
 
-    loc_resources = copy.deepcopy(resources)
+    previous = {}
+    if manifest is not None and os.path.exists(manifest):
+        with open(manifest, 'r') as infile:
+            previous = json.load(infile)
 
-    #Find game files
-    loc_resources['assetdir'] = loc_resources.root.apply(lambda x: os.path.join(x, asset_path)) 
-    loc_resources['filelist'] = loc_resources.assetdir.apply(os.listdir)
-    loc_resources = loc_resources.explode('filelist', ignore_index=True)
+    #all paths are compared in one form: absolute and normalized (relative mod directories,
+    #forward slashes on Windows)
+    previous = {os.path.normpath(os.path.abspath(p)):d for p, d in previous.items()}
+    if scope is not None:
+        scope = set(os.path.normpath(os.path.abspath(p)) for p in scope)
 
-    #Filter out unwanted files (only keep appropriate xml files)
-    loc_resources.rename(columns={'filelist':'basefilename'}, inplace=True)
-    loc_resources['keep'] = loc_resources.basefilename.apply(lambda x: os.path.splitext(x)[1] == '.xml') & loc_resources.basefilename.str.contains(file_pattern)
-    loc_resources = loc_resources[loc_resources.keep].reset_index(drop=True) 
-    loc_resources = loc_resources.drop('keep', axis=1)
-    loc_resources['fullpath'] = loc_resources.apply(lambda x: os.path.join(x['assetdir'], x['basefilename']), axis=1)
-    
-    #Parse the discovered files
-    loc_resources = pd.concat([loc_resources, pd.DataFrame(list(loc_resources['fullpath'].apply(
-        lambda x: parse_asset_file(x, taglist=taglist, convert=True, collapse_diffs=True))))], axis=1)
+    with stage('export', assets=len(store)) as record:
+        #render everything, grouped by output directory
+        outfilepaths = store.assets[path_col]
+        by_dir = {}
+        for asset_id, attributes in store.records():
+            outfilepath = os.path.normpath(os.path.abspath(outfilepaths.loc[asset_id]))
+            by_dir.setdefault(os.path.dirname(outfilepath), []).append((outfilepath, render_asset_xml_diff(attributes)))
+
+        if packed is not None:
+            report = _export_packed(by_dir, packed, previous, scope)
+            current = report.pop('current')
+            by_dir = {}
+        else:
+            report = {'written': 0, 'skipped': 0, 'removed': 0}
+            current = {}
         
-    return(loc_resources)
+        for outdir, outputs in by_dir.items():
+            os.makedirs(outdir, exist_ok=True)
+            for outfilepath, text in outputs:
+                digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+                current[outfilepath] = digest
+            
+                if manifest is not None:
+                    unchanged = previous.get(outfilepath) == digest and os.path.exists(outfilepath)
+                else:
+                    try:
+                        with open(outfilepath, 'r') as infile:
+                            unchanged = infile.read() == text
+                    except OSError:
+                        unchanged = False
+
+                if unchanged:
+                    report['skipped'] += 1
+                else:
+                    _write_atomic(outfilepath, text)
+                    report['written'] += 1
+
+        #remove diffs whose source asset disappeared since the last export (and loose diffs
+        #that are packed now)
+        stale = set(previous) - set(current) if packed is None else set(p for p in previous if os.path.isfile(p))
+        if scope is not None:
+            stale &= scope
+            current.update({p:d for p, d in previous.items() if p not in scope and p not in current})
+        for outfilepath in sorted(stale):
+            if os.path.exists(outfilepath):
+                os.remove(outfilepath)
+                report['removed'] += 1
+
+        #loose diffs that were packed before
+        if packed is None and modroot is not None:
+            owned = set(previous) if scope is None else scope
+            _unpack_owned(modroot, owned | set(current))
+
+        if manifest is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(manifest)), exist_ok=True)
+            _write_atomic(manifest, json.dumps(current, indent=1, sort_keys=True))
+        record.update(report)
+
+    return(report)
 
 #------------------------------------------------------------------------------
 
-def update_shields(resources, asset_path = 'assets/props/SurfaceElements/macros', 
-                   file_pattern=r'^shield.*', taglist = ['recharge']):
-    #Identifies and modified X4: Foundations shield files
-    #
-    #resources: pd.DataFrame of available unpacked input directories, contains resources root
-    #asset_path: path to relevant directory for the specific asset, relative to resource root
-    #file_pattern: regex pattern to id files in asset path to retain
-    #taglist: tags to extract from the identied input files    
+def _catalog_root(modroot, outfilepath):
+    #(catalog directory, path inside it) of an output file below the mod root: files of 
+    #extensions/<name>/ subdirectories go to the catalogs of that subdirectory
     
-    shield_resources = parse_resources(resources=resources, asset_path=asset_path, 
-                                       file_pattern=file_pattern, taglist=taglist)
+    parts = os.path.relpath(outfilepath, modroot).replace(os.sep, '/').split('/')
+    if parts[0] == '..':
+        raise ValueError('Packed output outside the mod directory: ' + str(outfilepath))
+    catroot = [os.path.abspath(modroot)]
+    while len(parts) > 2 and parts[0].lower() == 'extensions':
+        catroot += parts[:2]
+        parts = parts[2:]
+    return(os.path.join(*catroot), '/'.join(parts))
 
-    #capture owner/size/type from filename
-    shield_metadata = shield_resources.basefilename.str.extract(r'(shield_)(.*)(_)(s|m|l|xl)(_)(.*)(_.*)(mk.)(.*)', expand=True)
-    shield_metadata = shield_metadata.rename(columns={1:'race', 3:'size', 5:'type', 7:'mk'})
-    shield_resources = pd.concat([shield_resources, shield_metadata[['race', 'size', 'type', 'mk']]], axis=1)  
-    
-    #colname look up table (to retain xpath in colname so we dont have to reshape to long format)
-    #gives 'tag_attrib': xpath
-    modified_cols = {}
-    cnm_init = {}
-    for tag in taglist:
-        colpattern = r'.*(/' + str(tag) + r'/).*'
-        cnm_init.update({str(tag)+'_'+str(c)[str(c).rfind('/')+1:] :c for c in shield_resources.columns if re.match(colpattern, c)})
-    
-    vro_results = shield_resources[(shield_resources['source'] == 'vro')].reset_index()
-    base_results = shield_resources[(shield_resources['source'] == 'base')].reset_index()
+#------------------------------------------------------------------------------
 
-    modified = pd.merge(vro_results, base_results, how='left', on=['race', 'size', 'type', 'mk'], suffixes=['_vro', '_base'])
-    
-    #update colname map
-    cnm = copy.deepcopy(cnm_init)
-    cnm.update({str(k)+'_base':str(v)+'_base' for k, v in cnm_init.items()}) 
-    cnm.update({str(k)+'_vro':str(v)+'_vro' for k, v in cnm_init.items()}) 
-    
-    #modify values
-    max_factors = modified.groupby(['size', 'mk']).apply(lambda x: (x[cnm['recharge_max_vro']] / x[cnm['recharge_max_base']]).mean()).reset_index()
-    max_factors.rename(columns={0:'max_factor'}, inplace=True)
-    modified = modified.merge(max_factors, how='left', on=['size', 'mk'])
-    modified[cnm['recharge_max']] = modified[cnm['recharge_max_base']] * modified['max_factor']
-    modified.loc[(modified['race'].isin(['kha'])) | (modified[cnm['recharge_max']].isna()), cnm['recharge_max']] = modified[cnm['recharge_max_vro']]
-    modified_cols.update({'recharge_max': cnm['recharge_max']})
-
-    modified[cnm['recharge_delay']] = modified[cnm['recharge_delay_base']] * (3/2)
-    modified.loc[(modified['race'].isin(['kha'])) | (~modified['size'].isin(['s'])) | (modified[cnm['recharge_delay']].isna()), cnm['recharge_delay']] = modified[cnm['recharge_delay_vro']]
-    modified_cols.update({'recharge_delay': cnm['recharge_delay']})
-    
-    recharge_factors = modified.groupby(['size', 'mk']).apply(lambda x: (x[cnm['recharge_rate_vro']] / x[cnm['recharge_rate_base']]).mean()).reset_index()
-    recharge_factors.rename(columns={0:'recharge_factor'}, inplace=True)
-    modified = modified.merge(recharge_factors, how='left', on=['size', 'mk'])
-    modified[cnm['recharge_rate']] = modified[cnm['recharge_rate_base']] * modified['recharge_factor']
-    modified.loc[modified['size'].isin(['s']), cnm['recharge_rate']] = modified[cnm['recharge_rate_base']] * 0.9
-    modified.loc[modified['size'].isin(['m']), cnm['recharge_rate']] = modified[cnm['recharge_rate_base']] * modified['recharge_factor'] * 1.25
-    modified.loc[(modified['race'].isin(['kha'])) | (modified[cnm['recharge_rate']].isna()), cnm['recharge_rate']] = modified[cnm['recharge_rate_vro']]
-    modified_cols.update({'recharge_rate':cnm['recharge_rate']})
+def _export_packed(by_dir, modroot, previous, scope):
+    #Packed backend of export_asset_diffs: one write_catalog per catalog directory
+    #
+    #Archive entries this export does not own (not in the previous manifest, or outside
+    #scope) are carried over, e.g. the diffs of another asset class packed into the same mod.
     
-    return(modified, modified_cols)
+    catalogs = {}
+    current = {}
+    for outputs in by_dir.values():
+        for outfilepath, text in outputs:
+            catroot, path = _catalog_root(modroot, outfilepath)
+            catalogs.setdefault(catroot, {})[path] = text.encode('utf-8')
+            current[outfilepath] = hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    #catalogs that lost all their files still need the stale entries dropped
+    owned = set(previous if scope is None else scope)
+    for outfilepath in owned:
+        if outfilepath not in current:
+            catalogs.setdefault(_catalog_root(modroot, outfilepath)[0], {})
+
+    report = {'written': 0, 'skipped': 0, 'removed': 0, 'archives': 0}
+    for catroot, files in sorted(catalogs.items()):
+        keep = lambda path, catroot=catroot: os.path.normpath(os.path.join(catroot, path)) not in owned
+        counts = write_catalog(catroot, files, keep=keep)
+        for key in ['written', 'skipped', 'removed']:
+            report[key] += counts[key]
+        report['archives'] += counts['rewritten']
+
+    report['current'] = current
+    return(report)
 
 #------------------------------------------------------------------------------
 
-def update_engines(resources, asset_path = 'assets/props/Engines/macros', 
-                   file_pattern=r'^engine.*', taglist = ['thrust', 'boost', 'travel']):
-    #Identifies and modified X4: Foundations engine files
+def _unpack_owned(modroot, owned):
+    #Drops the entries of the owned output paths from the catalogs below the mod root, the
+    #loose counterpart of _export_packed (entries of other exports stay, emptied pairs go)
+
+    owned = set(os.path.normpath(os.path.abspath(p)) for p in owned)
+    catroots = set(_catalog_root(modroot, p)[0] for p in owned 
+                   if not os.path.relpath(p, modroot).startswith('..'))
+    for catroot in sorted(catroots):
+        if os.path.exists(os.path.join(catroot, 'ext_01.cat')):
+            keep = lambda path, catroot=catroot: os.path.normpath(os.path.join(catroot, path)) not in owned
+            write_catalog(catroot, {}, keep=keep)
+
+#------------------------------------------------------------------------------
+
+def write_catalog(catroot, files, name='ext_01', keep=None):
+    #Writes files into the X4:Foundations catalog pair <catroot>/<name>.cat and .dat
     #
-    #resources: pd.DataFrame of available unpacked input directories, contains resources root
-    #asset_path: path to relevant directory for the specific asset, relative to resource root
-    #file_pattern: regex pattern to id files in asset path to retain
-    #taglist: tags to extract from the identied input files    
-    
-    engine_resources = parse_resources(resources=resources, asset_path=asset_path, 
-                                       file_pattern=file_pattern, taglist=taglist)
+    #catroot: directory of the catalog (mod root or one of its extensions/<name> dirs)
+    #files: dict of path inside catroot ('/' separated): bytes
+    #name: catalog file name without extension
+    #keep: optional callable(path), entries of the existing catalog missing from files are
+    #      carried over where it returns True and dropped otherwise (all dropped without it)
+    #
+    #The .dat is written front to back in one pass while the offsets, sizes and md5 hashes
+    #are recorded for the catalog lines; both go to temporary files that then replace the
+    #old .dat and .cat one after the other (not as one atomic step).  Nothing is written 
+    #when every entry matches the existing catalog, whose md5 hashes are the change check.
+    #An existing pair is only trusted when the .dat size is the sum of the catalog sizes 
+    #(else it is rebuilt from files alone, e.g. after a crash between the two replaces), 
+    #carried entries whose data does not match their md5 are dropped.  A pair left without
+    #entries is deleted.  Returns dict of written, skipped and removed entries and whether 
+    #the pair was rewritten.
 
-    #capture owner/size/type from filename
-    engine_metadata = engine_resources.basefilename.str.extract(r'(engine_)(.*)(_)(s|m|l|xl)(_)(.*)(_.*)(mk.)(.*)', expand=True)
-    engine_metadata = engine_metadata.rename(columns={1:'race', 3:'size', 5:'type', 7:'mk'})
-    engine_resources = pd.concat([engine_resources, engine_metadata[['race', 'size', 'type', 'mk']]], axis=1)  
-    
-    #colname look up table (to retain xpath in colname so we dont have to reshape to long format)
-    #gives 'tag_attrib': xpath
-    modified_cols = {}
-    cnm_init = {}
-    for tag in taglist:
-        colpattern = r'.*(/' + str(tag) + r'/).*'
-        cnm_init.update({str(tag)+'_'+str(c)[str(c).rfind('/')+1:] :c for c in engine_resources.columns if re.match(colpattern, c)})
-    
-    #Further filter observations to only those with travel stats (eliminate thrusters etc)
-    engine_resources = engine_resources[~engine_resources[cnm_init['travel_thrust']].isna()].reset_index(drop=True)
+    catfile = os.path.join(catroot, name + '.cat')
+    datfile = os.path.join(catroot, name + '.dat')
+    old = {}
+    rebuild = False
+    if os.path.exists(catfile) and os.path.exists(datfile):
+        old = collections.OrderedDict(CatalogIndex.read_catalog(catfile, catroot))
+        if sum(entry.size for entry in old.values()) != os.path.getsize(datfile):
+            old = {}
+            rebuild = True
+    elif os.path.exists(catfile) or os.path.exists(datfile):
+        rebuild = True
 
-    engine_resources['eff_boost_thrust'] = engine_resources[cnm_init['thrust_forward']] * engine_resources[cnm_init['boost_thrust']]
-    engine_resources['eff_travel_thrust'] = engine_resources[cnm_init['thrust_forward']] * engine_resources[cnm_init['travel_thrust']]
-    
-    vro_results = engine_resources[(engine_resources['source'] == 'vro')].reset_index()
-    base_results = engine_resources[(engine_resources['source'] == 'base')].reset_index()
+    entries = []
+    counts = {'written': 0, 'skipped': 0, 'removed': 0, 'rewritten': False}
+    for path in sorted(files):
+        data = files[path]
+        md5 = hashlib.md5(data).hexdigest()
+        previous = old.get(path)
+        if previous is not None and previous.md5 == md5:
+            entries.append((path, data, previous.mtime, md5))
+            counts['skipped'] += 1
+        else:
+            entries.append((path, data, int(time.time()), md5))
+            counts['written'] += 1
 
-    modified = pd.merge(vro_results, base_results, how='left', on=['race', 'size', 'type', 'mk'], suffixes=['_vro', '_base'])
-    
-    #update colname map
-    cnm = copy.deepcopy(cnm_init)
-    cnm.update({str(k)+'_base':str(v)+'_base' for k, v in cnm_init.items()}) 
-    cnm.update({str(k)+'_vro':str(v)+'_vro' for k, v in cnm_init.items()}) 
-    
-    #modify values
-    
-    #Calculate average conversion factors for vro <-> base thrust to allow us to normalize new engines
-    thrust_factors = modified.groupby(['size', 'mk', 'type']).apply(lambda x: (x[cnm['thrust_forward_vro']] / x[cnm['thrust_forward_base']]).mean()).reset_index()
-    thrust_factors.rename(columns={0:'thrust_factor'}, inplace=True)
-    modified = modified.merge(thrust_factors, how='left', on=['size', 'mk', 'type'])
-
-    attack_factors = modified.groupby(['size', 'mk', 'type']).apply(lambda x: (x[cnm['travel_attack_vro']] / x[cnm['travel_attack_base']]).mean()).reset_index()
-    attack_factors.rename(columns={0:'attack_factor'}, inplace=True)
-    modified = modified.merge(attack_factors, how='left', on=['size', 'mk', 'type'])
-    
-    #Calculate effective normalized thrust values
-    modified['thrust_forward_pre'] = modified[cnm['thrust_forward_vro']]
+    carried = [path for path in old if path not in files and keep is not None and keep(path)]
+    counts['removed'] = len(old) - len(carried) - sum(1 for path in files if path in old)
+    if not counts['written'] and not counts['removed'] and not rebuild:
+        return(counts)
 
-    modified['boost_thrust_pre'] = modified['eff_boost_thrust_base'] / modified['thrust_forward_pre']
-    modified.loc[modified['boost_thrust_pre'].isna(), 'boost_thrust_pre'] = modified['eff_boost_thrust_vro'] / ( modified[cnm['thrust_forward_vro']] / modified['thrust_factor'])
-    modified['travel_thrust_pre'] = modified['eff_travel_thrust_base'] / modified['thrust_forward_pre']
-    modified.loc[modified['travel_thrust_pre'].isna(), 'travel_thrust_pre'] = modified['eff_travel_thrust_vro'] / ( modified[cnm['thrust_forward_vro']] / modified['thrust_factor'])
-    
-    modified['eff_boost_thrust_pre'] = modified['thrust_forward_pre'] * modified['boost_thrust_pre']
-    modified['eff_travel_thrust_pre'] = modified['thrust_forward_pre'] * modified['travel_thrust_pre']
-    
-    #Create initial boost and travel thrust rankings so we can match them later
-    modified.sort_values(['size', 'thrust_forward_pre'], inplace=True)
-    modified['travel_rank'] = modified.groupby('size')['eff_travel_thrust_pre'].rank(axis=1, ascending=False, method='first')
-    modified['boost_rank'] = modified.groupby('size')['eff_boost_thrust_pre'].rank(axis=1, ascending=False, method='first')
-    modified = pd.merge(modified, modified, left_on=['size', 'travel_rank'], right_on=['size', 'boost_rank'], suffixes=['_original', '_ranked'] )
-        
-    #update name mapping
-    cnm.update({str(k)+'_base_original':str(v)+'_base_original' for k, v in cnm_init.items()}) 
-    cnm.update({str(k)+'_base_ranked':str(v)+'_base_ranked' for k, v in cnm_init.items()}) 
-    cnm.update({str(k)+'_vro_original':str(v)+'_vro_original' for k, v in cnm_init.items()}) 
-    cnm.update({str(k)+'_vro_ranked':str(v)+'_vro_ranked' for k, v in cnm_init.items()}) 
-    
-    #-------------------------------------------------------------------------
+    if carried:
+        with open(datfile, 'rb') as infile:
+            for path in carried:
+                infile.seek(old[path].offset)
+                data = infile.read(old[path].size)
+                if hashlib.md5(data).hexdigest() != old[path].md5:
+                    counts['removed'] += 1
+                    continue
+                entries.append((path, data, old[path].mtime, old[path].md5))
+        entries.sort(key=lambda entry: entry[0])
 
-    #calculate final engine params based upon relative base boost and travel rank
-    modified[cnm['thrust_forward']] = modified[cnm['thrust_forward_vro_original']]
-    modified_cols.update({'thrust_forward': cnm['thrust_forward']})
+    counts['rewritten'] = True
+    if not entries:
+        for outfilepath in [catfile, datfile]:
+            if os.path.exists(outfilepath):
+                os.remove(outfilepath)
+        return(counts)
 
-    modified[cnm['thrust_reverse']] = modified[cnm['thrust_reverse_base_original']] * modified['thrust_factor_original']
-    modified.loc[modified[cnm['thrust_reverse']].isna(), cnm['thrust_reverse']] = modified[cnm['thrust_reverse_vro_original']]
-    modified_cols.update({'thrust_reverse': cnm['thrust_reverse']})
-    
-    modified['eff_boost_thrust'] = modified['eff_boost_thrust_pre_original']
-    modified[cnm['boost_thrust']] = modified['eff_boost_thrust'] / modified[cnm['thrust_forward']]
-    modified_cols.update({'boost_thrust': cnm['boost_thrust']})
-    
-    modified[cnm['boost_duration']] = modified[cnm['boost_duration_base_original']]
-    modified.loc[modified[cnm['boost_duration']].isna(), cnm['boost_duration']] = modified[cnm['boost_duration_vro_original']] / modified['attack_factor_original']    
-    modified_cols.update({'boost_duration': cnm['boost_duration']})
-    
-    modified[cnm['boost_attack']] = modified[cnm['boost_attack_base_original']]
-    modified.loc[modified[cnm['boost_attack']].isna(), cnm['boost_attack']] = modified[cnm['boost_attack_vro_original']] / modified['attack_factor_original']    
-    modified_cols.update({'boost_attack': cnm['boost_attack']})
+    os.makedirs(catroot, exist_ok=True)
+    tmpsuffix = '.' + str(os.getpid()) + '.tmp'
+    lines = []
+    with open(datfile + tmpsuffix, 'wb') as outfile:
+        for path, data, mtime, md5 in entries:
+            outfile.write(data)
+            lines.append(path + ' ' + str(len(data)) + ' ' + str(mtime) + ' ' + md5 + '\n')
+    with open(catfile + tmpsuffix, 'w', encoding='utf-8', newline='\n') as outfile:
+        outfile.write(''.join(lines))
     
-    modified[cnm['boost_release']] = modified[cnm['boost_release_base_original']]
-    modified.loc[modified[cnm['boost_release']].isna(), cnm['boost_release']] = modified[cnm['boost_release_vro_original']] / modified['attack_factor_original']    
-    modified_cols.update({'boost_release': cnm['boost_release']})
+    os.replace(datfile + tmpsuffix, datfile)
+    os.replace(catfile + tmpsuffix, catfile)
     
-    modified.loc[(modified['race_original'].isin(['par'])) & (modified['size'].isin(['l', 'xl'])), cnm['boost_duration']] = modified[cnm['boost_duration']] * 2
-    modified.loc[(modified['race_original'].isin(['spl'])) & (modified['size'].isin(['l', 'xl'])) , cnm['boost_attack']] = modified[cnm['boost_attack']] * 0.5
-    modified.loc[(modified['race_original'].isin(['spl'])) & (modified['size'].isin(['l', 'xl'])) , cnm['boost_release']] = modified[cnm['boost_release']] * 0.5
-    modified.loc[(modified['race_original'].isin(['arg', 'tel'])) & (modified['size'].isin(['l', 'xl'])), cnm['boost_duration']] = modified[cnm['boost_duration']] * 1.33
-    modified.loc[(modified['race_original'].isin(['arg', 'tel'])) & (modified['size'].isin(['l', 'xl'])) , cnm['boost_attack']] = modified[cnm['boost_attack']] * 0.75
-    modified.loc[(modified['race_original'].isin(['arg', 'tel'])) & (modified['size'].isin(['l', 'xl'])) , cnm['boost_release']] = modified[cnm['boost_release']] * 0.75
-    
-    modified['eff_travel_thrust'] = modified['eff_travel_thrust_pre_original']
-    modified.loc[modified['size'].isin(['s', 'm']), 'eff_travel_thrust'] = modified['eff_boost_thrust_pre_ranked']
-    modified.loc[modified['size'].isin(['l', 'xl']), 'eff_travel_thrust'] = modified['eff_travel_thrust'] * (5/3)          
-    modified[cnm['travel_thrust']] = modified['eff_travel_thrust'] / modified[cnm['thrust_forward']]
-    modified_cols.update({'travel_thrust': cnm['travel_thrust']})
-    
-    modified[cnm['travel_charge']] = modified[cnm['travel_charge_base_original']]
-    modified.loc[modified[cnm['travel_charge']].isna(), cnm['travel_charge']] = modified[cnm['travel_charge_vro_original']] / modified['attack_factor_original']    
-    modified_cols.update({'travel_charge': cnm['travel_charge']})
-    
-    modified[cnm['travel_attack']] = modified[cnm['travel_attack_base_original']]
-    modified.loc[modified[cnm['travel_attack']].isna(), cnm['travel_attack']] = modified[cnm['travel_attack_vro_original']] / modified['attack_factor_original']        
-    modified_cols.update({'travel_attack': cnm['travel_attack']})
-    
-    modified[cnm['travel_release']] = modified[cnm['travel_release_base_original']]
-    modified.loc[modified[cnm['travel_release']].isna(), cnm['travel_release']] = modified[cnm['travel_release_vro_original']] / modified['attack_factor_original']
-    modified_cols.update({'travel_release': cnm['travel_release']})    
-           
-    modified.loc[(modified['race_original'].isin(['ter'])) & (modified['size'].isin(['l', 'xl'])), cnm['travel_charge']] = modified[cnm['travel_charge']] * 0.75
-    
-    return(modified, modified_cols)
+    return(counts)
 
-#==============================================================================
+#------------------------------------------------------------------------------
 
-if __name__ == "__main__":
-    
-    pd.options.plotting.backend = "plotly"
-    pio.renderers.default ='browser'
-    
-    #Params    
-    #Output (mod) directories
-    sum_outdir = '.'
-    
-    mod_shields = True
-    outdir_shields = 'F:/Steam/steamapps/common/X4 Foundations/extensions/al_shieldmod_vro'
-    
-    mod_engines = True
-    outdir_engines = 'F:/Steam/steamapps/common/X4 Foundations/extensions/al_travelmod_vro'
+class ParseCache(object):
+    #Persistent on-disk cache of parse_asset_file results, stored in one SQLite file
+    #
+    #dbpath: path to the cache database (created if missing)
+    #max_bytes: total size of cached results kept after eviction, least recently used go first
+    #hash_contents: if True a sha1 of the file contents is part of the fingerprint in
+    #               addition to mtime and size (slower, but immune to mtime-preserving copies)
+    #
+    #Entries are keyed by absolute (or archive virtual) path plus a variant string built 
+    #from the taglist and the convert/collapse_diffs flags, and are valid while the file 
+    #fingerprint matches.  Overlay chains (tuples of files, see resolve_overlay) are keyed
+    #by all their paths and valid while every file matches.
+
+    def __init__(self, dbpath, max_bytes=64*1024*1024, hash_contents=False):
+        self.dbpath = dbpath
+        self.max_bytes = max_bytes
+        self.hash_contents = hash_contents
+        self.hits = 0
+        self.misses = 0
+
+        dbdir = os.path.dirname(os.path.abspath(dbpath))
+        os.makedirs(dbdir, exist_ok=True)
+        self.conn = sqlite3.connect(dbpath)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                          'path TEXT NOT NULL, variant TEXT NOT NULL, '
+                          'mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, digest TEXT, '
+                          'result BLOB NOT NULL, last_used REAL NOT NULL, '
+                          'PRIMARY KEY (path, variant))')
+        self.conn.commit()
+
+    @staticmethod
+    def variant(taglist, convert=True, collapse_diffs=True, overlay=False):
+        return(json.dumps([[str(t) for t in taglist], bool(convert), bool(collapse_diffs)] + 
+                          (['overlay'] if overlay else [])))
+
+    @staticmethod
+    def key(path):
+        if isinstance(path, CatalogEntry):
+            return(path.fullpath)
+        if isinstance(path, tuple):
+            return('\n'.join(ParseCache.key(p) for p in path))
+        return(os.path.abspath(path))
+
+    def fingerprint(self, path):
+        if isinstance(path, tuple) and not isinstance(path, CatalogEntry):
+            fingerprints = [self.fingerprint(p) for p in path]
+            return((max(fp[0] for fp in fingerprints), sum(fp[1] for fp in fingerprints),
+                    hashlib.sha1(repr(fingerprints).encode('utf-8')).hexdigest()))
+        if isinstance(path, CatalogEntry):
+            return((path.mtime * 10**9, path.size, path.md5 if self.hash_contents else None))
         
-    #Unpacked root directories
-    base_root = 'F:/Games/Mods/x4_extracted'    
-    vro_root = 'F:/Games/Mods/x4_extracted/extensions/vro' 
-    
-    #List of expansions to consider
-    resource_list = ['base', 'split', 'terran', 'vro_base']
-    
-    #Hardcoded inputs for convenience
-    resources = pd.DataFrame(resource_list, columns=['resource'])
-    resources.loc[resources.resource == 'base', 'root'] = base_root
-    resources.loc[resources.resource == 'split', 'root'] = 'F:/Games/Mods/x4_extracted/extensions/ego_dlc_split'
-    resources.loc[resources.resource == 'terran', 'root'] = 'F:/Games/Mods/x4_extracted/extensions/ego_dlc_terran'
-    resources.loc[resources.resource == 'vro_base', 'root'] = vro_root
-
-    #Gather inputs for all expansions interactively if not hardcoded above
-    root = tk.Tk()
-    root.withdraw()    
-    for grp in resource_list:
+        stat = os.stat(path)
+        digest = None
+        if self.hash_contents:
+            with open(path, 'rb') as infile:
+                digest = hashlib.sha1(infile.read()).hexdigest()
+        return((stat.st_mtime_ns, stat.st_size, digest))
+
+    def lookup(self, filelist, variant):
+        #Returns (results, fingerprints): results holds the cached dict for every valid 
+        #entry and None otherwise, fingerprints the current fingerprint of each file
+
+        keys = [self.key(f) for f in filelist]
+        fingerprints = [self.fingerprint(f) for f in filelist]
+
+        #one bulk read of everything cached for this variant
+        cached = {row[0]:row[1:] for row in self.conn.execute(
+            'SELECT path, mtime_ns, size, digest, result FROM entries WHERE variant = ?', (variant,))}
+
+        results = []
+        for key, fp in zip(keys, fingerprints):
+            entry = cached.get(key)
+            if entry is not None and tuple(entry[:3]) == fp:
+                results.append(pickle.loads(entry[3]))
+            else:
+                results.append(None)
+
+        hit_keys = [(time.time(), key, variant) for key, r in zip(keys, results) if r is not None]
+        self.conn.executemany('UPDATE entries SET last_used = ? WHERE path = ? AND variant = ?', hit_keys)
+        self.conn.commit()
+        self.hits += len(hit_keys)
+        self.misses += len(keys) - len(hit_keys)
+
+        return(results, fingerprints)
+
+    def store(self, filelist, fingerprints, results, variant):
+        now = time.time()
+        self.conn.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              [(self.key(f), variant, fp[0], fp[1], fp[2], 
+                                pickle.dumps(r, protocol=pickle.HIGHEST_PROTOCOL), now)
+                               for f, fp, r in zip(filelist, fingerprints, results)])
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        #Drops least recently used entries until the cached results fit in max_bytes
+        if self.max_bytes is None:
+            return(0)
+        cur = self.conn.execute('DELETE FROM entries WHERE rowid IN ('
+                                'SELECT rowid FROM (SELECT rowid, SUM(LENGTH(result)) OVER '
+                                '(ORDER BY last_used DESC, rowid DESC) AS running FROM entries) '
+                                'WHERE running > ?)', (self.max_bytes,))
+        self.conn.commit()
+        return(cur.rowcount)
+
+    def invalidate(self, paths=None):
+        #Removes the given paths from the cache, or everything if paths is None
+        if paths is None:
+            self.conn.execute('DELETE FROM entries')
+        else:
+            self.conn.executemany('DELETE FROM entries WHERE path = ?', [(self.key(p),) for p in paths])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+#------------------------------------------------------------------------------
+
+#Location of one file packed in a .cat/.dat pair: virtual full path (resource root joined
+#with the catalog path), .dat file, byte offset, size, catalog timestamp and md5
+CatalogEntry = collections.namedtuple('CatalogEntry', ['fullpath', 'datfile', 'offset', 'size', 'mtime', 'md5'])
+
+_dat_maps = {}
+
+def read_catalog_entry(entry):
+    #Reads the bytes of a packed file through a (per process) memory map of its .dat file
+    #
+    #entry: CatalogEntry
+
+    if entry.size == 0:
+        return(b'')
+
+    datmap = _dat_maps.get(entry.datfile)
+    if datmap is None:
+        with open(entry.datfile, 'rb') as datfile:
+            datmap = mmap.mmap(datfile.fileno(), 0, access=mmap.ACCESS_READ)
+        _dat_maps[entry.datfile] = datmap
+
+    return(datmap[entry.offset:entry.offset + entry.size])
+
+#------------------------------------------------------------------------------
+
+class CatalogIndex(object):
+    #In-memory index of the X4:Foundations .cat/.dat archives found in one resource root
+    #
+    #root: directory holding the catalogs (game install dir or an extension dir)
+    #
+    #Every non-signature .cat file is read in load order (later catalogs override earlier
+    #ones for the same path).  Each catalog line is '<path> <size> <timestamp> <md5>' and
+    #the packed data sits back to back in the matching .dat file.  Lookups are case 
+    #insensitive, like the game's own file system.
+
+    def __init__(self, root):
+        self.root = root
+        self.entries = {}
+        self.dirs = {}
+
+        for catfile in self.catalog_files(root):
+            for path, entry in self.read_catalog(catfile, root):
+                self.entries[self.normpath(path)] = (path, entry)
+
+        for key, (path, entry) in self.entries.items():
+            dirname, basename = key.rpartition('/')[0], path.rpartition('/')[2]
+            self.dirs.setdefault(dirname, []).append(basename)
+
+    @staticmethod
+    def read_catalog(catfile, root):
+        #Yields (path, CatalogEntry) for every line of one catalog, in file order
+        datfile = os.path.splitext(catfile)[0] + '.dat'
+        offset = 0
+        with open(catfile, 'r', encoding='utf-8') as infile:
+            for line in infile:
+                line = line.rstrip('\r\n')
+                if not line:
+                    continue
+                path, size, mtime, md5 = line.rsplit(' ', 3)
+                size = int(size)
+                yield((path, CatalogEntry(os.path.join(root, path), datfile, offset, size, int(mtime), md5)))
+                offset += size
+
+    @staticmethod
+    def catalog_files(root):
+        def load_order(catfile):
+            stem = os.path.splitext(os.path.basename(catfile))[0]
+            prefix, _, number = stem.rpartition('_') if '_' in stem else ('', '', stem)
+            return((prefix, int(number) if number.isdigit() else 0, stem))
+
+        catfiles = [f for f in glob.glob(os.path.join(glob.escape(root), '*.cat')) 
+                    if not f.lower().endswith('_sig.cat')]
+        return(sorted(catfiles, key=load_order))
+
+    @staticmethod
+    def normpath(path):
+        return(str(path).replace('\\', '/').strip('/').lower())
+
+    def listdir(self, path):
+        #Basenames of the packed files directly inside path (relative to root)
+        return(list(self.dirs.get(self.normpath(path), [])))
+
+    def entry(self, path):
+        #CatalogEntry for path (relative to root)
+        return(self.entries[self.normpath(path)][1])
+
+    def read(self, path):
+        return(read_catalog_entry(self.entry(path)))
+
+#------------------------------------------------------------------------------
+
+@functools.lru_cache(maxsize=None)
+def get_catalog_index(root):
+    #Returns the (memoized) CatalogIndex of a resource root
+    return(CatalogIndex(root))
+
+def close_catalogs():
+    #Closes the .dat memory maps and forgets the memoized CatalogIndex of every root
+    #
+    #Call it before archives that were read get rewritten (a mapped .dat cannot be replaced 
+    #on Windows) and to read rewritten archives again rather than the stale index.
+    for datmap in _dat_maps.values():
+        datmap.close()
+    _dat_maps.clear()
+    get_catalog_index.cache_clear()
+
+#------------------------------------------------------------------------------
+
+def parse_files(filelist, taglist, executor='serial', max_workers=None, chunksize=1, cache=None, overlay=False):
+    #Parses a list of X4:Foundations asset files, optionally in parallel
+    #
+    #filelist: list of file paths (or CatalogEntry) to parse
+    #taglist: tags to extract from the identied input files
+    #executor: one of 'serial', 'thread' or 'process'
+    #max_workers: worker count for the thread/process pool (None lets the pool decide)
+    #chunksize: number of files handed to a process pool worker at a time
+    #cache: optional ParseCache (or path to its database), only files missing from it are parsed
+    #overlay: if True filelist holds overlay chains (tuples of files) resolved with resolve_overlay
+    #
+    #Results are returned in the same order as filelist regardless of executor
+
+    with stage('parse', files=len(filelist), executor=executor, overlay=bool(overlay)) as record:
+        if cache is None:
+            return(_parse_files(filelist, taglist, executor, max_workers, chunksize, overlay))
+
+        if not isinstance(cache, ParseCache):
+            cache = ParseCache(cache)
         
-        missingvals = resources.loc[resources['resource'] == grp, 'root'].isna()
-        if any(missingvals) or len(missingvals) == 0:
-            resources.loc[resources['resource'] == grp, 'root'] = filedialog.askdirectory(title=str(grp) + " dir")
-                
-    #provide paths to vro expansion files given base game expansions identified in resource_list
-    for grp in resource_list:
-        vro_grp = 'vro_' + str(grp)
-        if (grp not in ['base', 'vro_base']) and (vro_grp not in resources.resource.unique()):
-            
-            resources = resources.append({'resource':vro_grp, 
-                                          'root':os.path.join(resources.loc[resources.resource=='vro_base', 'root'].values[0], 
-                                                              'extensions', 
-                                                              os.path.split(resources.loc[resources.resource==grp, 'root'].values[0])[1])}, 
-                                         ignore_index=True)
-    
-    #Set source base vs vro input metadata
-    resources['source'] = 'base'                                          
-    resources.loc[resources.resource.str.contains(r'^vro_.*'), 'source'] = 'vro'
-    
-    #--------------------------------------------------------------------------
-    
-    #Modify shield parameters
-    if mod_shields:
-        modified_shields, modified_shields_colmap = update_shields(resources=resources)
-        modified_shields['fullpath_final'] = modified_shields['fullpath_vro'].str.replace(vro_root, outdir_shields)
+        variant = ParseCache.variant(taglist, convert=True, collapse_diffs=True, overlay=overlay)
+        results, fingerprints = cache.lookup(filelist, variant)
         
-        #Export diff files
-        modified_shields.apply(lambda x: export_asset_xml_diff(outfilepath = x['fullpath_final'], 
-                                                               attributes = x[modified_shields_colmap.values()].to_dict()),
-                               axis=1)    
-
-        #Validation
-        shields_fig = px.scatter(modified_shields, 
-                                 x=modified_shields_colmap['recharge_delay'], 
-                                 y=modified_shields_colmap['recharge_rate'], 
-                                 text='basefilename_vro')
-        shields_fig.update_traces(textposition='top center')
-        shields_fig.update_layout(
-                height=800,
-                title_text='Recharge delay vs rate'
-                )
-        shields_fig.show()
-        shields_fig.write_image(os.path.join(sum_outdir, 'modified_shields.png'))
+        missing = [i for i, r in enumerate(results) if r is None]
+        record['cached'] = len(filelist) - len(missing)
+        if missing:
+            parsed = _parse_files([filelist[i] for i in missing], taglist, executor, max_workers, chunksize, overlay)
+            for i, r in zip(missing, parsed):
+                results[i] = r
+            cache.store([filelist[i] for i in missing], [fingerprints[i] for i in missing], parsed, variant)
+
+        return(results)
+
+#------------------------------------------------------------------------------
+
+def _parse_files(filelist, taglist, executor, max_workers, chunksize, overlay=False):
+
+    parse = functools.partial(resolve_overlay if overlay else parse_asset_file, 
+                              taglist=taglist, convert=True, collapse_diffs=True)
+
+    if executor == 'serial' or len(filelist) <= 1:
+        return([parse(f) for f in filelist])
+    elif executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+    elif executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=max_workers)
+    else:
+        raise ValueError('Unknown executor: ' + str(executor))
+
+    with pool:
+        results = list(pool.map(parse, filelist, chunksize=max(int(chunksize), 1)))
+
+    return(results)
+
+#------------------------------------------------------------------------------
+
+def find_resource_files(resources, asset_path, file_pattern, archives=False):
+    #Lists the X4:Foundations asset files of every resource matching the input filters
+    #
+    #resources: pd.DataFrame of available input directories, contains resources root
+    #asset_path: path to relevant directory for the specific asset, relative to resource root
+    #file_pattern: regex pattern to id files in asset path to retain
+    #archives: if True the roots are read as packed .cat/.dat archives rather than unpacked 
+    #          directories, listing and reading go through the CatalogIndex of each root
+    #
+    #Returns (files, filelist): one row per file, and the matching paths/CatalogEntry to parse
+
+    with stage('list', archives=bool(archives)) as record:
+        loc_resources = copy.deepcopy(resources)
+
+        #Find game files
+        loc_resources['assetdir'] = loc_resources.root.apply(lambda x: os.path.join(x, asset_path)) 
+        if archives:
+            loc_resources['filelist'] = loc_resources.root.apply(lambda x: get_catalog_index(x).listdir(asset_path))
+        else:
+            loc_resources['filelist'] = loc_resources.assetdir.apply(os.listdir)
+        loc_resources = loc_resources.explode('filelist', ignore_index=True)
+        record['listed'] = len(loc_resources)
+
+        #Filter out unwanted files (only keep appropriate xml files)
+        loc_resources.rename(columns={'filelist':'basefilename'}, inplace=True)
+        loc_resources['keep'] = loc_resources.basefilename.apply(lambda x: os.path.splitext(x)[1] == '.xml') & loc_resources.basefilename.str.contains(file_pattern)
+        loc_resources = loc_resources[loc_resources.keep].reset_index(drop=True) 
+        loc_resources = loc_resources.drop('keep', axis=1)
+        loc_resources['fullpath'] = loc_resources.apply(lambda x: os.path.join(x['assetdir'], x['basefilename']), axis=1)
         
-        modified_shields.to_csv(os.path.join(sum_outdir, 'modified_shields.csv'))    
-    
-    #--------------------------------------------------------------------------
-    
-    #Modify engine parameters
-    if mod_engines:
-        modified_engines, modified_engines_colmap = update_engines(resources=resources)
-        modified_engines['fullpath_final'] = modified_engines['fullpath_vro_original'].str.replace(vro_root, outdir_engines)
+        if archives:
+            filelist = [get_catalog_index(root).entry(asset_path + '/' + name) 
+                        for root, name in zip(loc_resources['root'], loc_resources['basefilename'])]
+        else:
+            filelist = list(loc_resources['fullpath'])
+        record['files'] = len(filelist)
+            
+        return(loc_resources, filelist)
+
+#------------------------------------------------------------------------------
+
+#one location step of a diff sel xpath: axis ('/' or '//'), tag (or '*'), [@attr='value'] 
+#predicates and an optional [n] position
+_SelStep = collections.namedtuple('_SelStep', ['axis', 'tag', 'attrs', 'position'])
+
+_SEL_STEP = re.compile(r'(//?)([A-Za-z_][\w.\-]*|\*)((?:\[[^\]]*\])*)')
+_SEL_PRED = re.compile(r'''\[\s*(?:@([\w.\-]+)\s*=\s*(?:'([^']*)'|"([^"]*)")|(\d+))\s*\]''')
+_SEL_ATTR = re.compile(r'^(.*)/@([\w.\-]+)$')
+
+def _parse_sel(sel):
+    #Splits a diff sel into (steps, attribute name or None), None if it is outside the
+    #supported subset (the full xpath is then evaluated by lxml)
+
+    match = _SEL_ATTR.match(sel)
+    path, attr = (match.group(1), match.group(2)) if match else (sel, None)
+
+    steps = []
+    pos = 0
+    while pos < len(path):
+        step = _SEL_STEP.match(path, pos)
+        if step is None:
+            return(None)
+        pos = step.end()
+
+        attrs, position, consumed = [], None, 0
+        for pred in _SEL_PRED.finditer(step.group(3)):
+            if pred.start() != consumed:
+                return(None)
+            consumed = pred.end()
+            if pred.group(4) is not None:
+                position = int(pred.group(4))
+            else:
+                attrs.append((pred.group(1), pred.group(2) if pred.group(2) is not None else pred.group(3)))
+        if consumed != len(step.group(3)) or (position is not None and (attrs or step.group(2) == '*')):
+            return(None)
+        steps.append(_SelStep(step.group(1), step.group(2), attrs, position))
+
+    if not steps:
+        return(None)
+    return(steps, attr)
+
+#------------------------------------------------------------------------------
+
+class OverlayDocument(object):
+    #Asset document with X4 <diff> patches applied to it
+    #
+    #root: root element of the (full, non diff) asset document, modified in place
+    #
+    #sel xpaths are resolved through an index of the elements by tag: the candidates for 
+    #the last step are checked against the earlier steps by walking up their ancestors 
+    #instead of searching the tree.  The index is only rebuilt after a patch added or 
+    #removed elements, attribute patches (the bulk of balance mods) keep it.  Selectors 
+    #outside the indexed subset (functions, text(), ...) go to lxml xpath.
+    #Like RFC 5261 patches, an operation is only applied when its sel matches exactly
+    #one node, the others are counted in skipped.
+
+    def __init__(self, root):
+        self.tree = etree.ElementTree(root)
+        self.index = None
+        self.skipped = 0
+
+    def _build_index(self):
+        self.index = {'*': []}
+        for elem in self.tree.getroot().iter(etree.Element):
+            self.index.setdefault(elem.tag, []).append(elem)
+            self.index['*'].append(elem)
+
+    @staticmethod
+    def _step_matches(elem, step):
+        if step.tag != '*' and elem.tag != step.tag:
+            return(False)
+        if any(elem.get(name) != value for name, value in step.attrs):
+            return(False)
+        if step.position is not None:
+            return(sum(1 for _ in elem.itersiblings(elem.tag, preceding=True)) + 1 == step.position)
+        return(True)
+
+    def _path_matches(self, elem, steps, i):
+        #does steps[:i+1] select elem
+        if not self._step_matches(elem, steps[i]):
+            return(False)
+        if i == 0:
+            return(steps[0].axis == '//' or elem.getparent() is None)
+        if steps[i].axis == '/':
+            parent = elem.getparent()
+            return(parent is not None and self._path_matches(parent, steps, i - 1))
+        return(any(self._path_matches(anc, steps, i - 1) for anc in elem.iterancestors()))
+
+    def select(self, sel):
+        #Returns (elements, attribute name or None) selected by a diff sel xpath
+
+        parsed = _parse_sel(sel)
+        if parsed is None:
+            try:
+                found = self.tree.xpath(sel)
+            except etree.XPathError:
+                return([], None)
+            if not isinstance(found, list):
+                return([], None)
+            if found and all(getattr(r, 'is_attribute', False) for r in found):
+                return([r.getparent() for r in found], found[0].attrname if len(found) == 1 else None)
+            return([r for r in found if isinstance(r, etree._Element)], None)
+
+        steps, attr = parsed
+        if self.index is None:
+            self._build_index()
+        nodes = [elem for elem in self.index.get(steps[-1].tag, []) 
+                 if self._path_matches(elem, steps, len(steps) - 1)]
+        if attr is not None:
+            nodes = [elem for elem in nodes if attr in elem.attrib]
+        return(nodes, attr)
+
+    def apply(self, diff):
+        #Applies the add/replace/remove operations of a <diff> root element in order
+
+        for op in diff.iterchildren(etree.Element):
+            condition = op.get('if')
+            if condition and not self.tree.xpath(condition):
+                continue
+
+            nodes, attr = self.select(op.get('sel', ''))
+            if len(nodes) != 1:
+                self.skipped += 1
+                continue
+            node = nodes[0]
+            children = [copy.deepcopy(c) for c in op.iterchildren(etree.Element)]
+
+            if op.tag == 'replace' and attr is not None:
+                node.set(attr, op.text or '')
+            elif op.tag == 'replace' and children:
+                parent = node.getparent()
+                if parent is None:
+                    self.tree = etree.ElementTree(children[0])
+                else:
+                    children[0].tail = node.tail
+                    parent.replace(node, children[0])
+                self.index = None
+            elif op.tag == 'add' and op.get('type', '').startswith('@'):
+                node.set(op.get('type')[1:], op.text or '')
+            elif op.tag == 'add' and attr is None and children:
+                pos = op.get('pos', 'append')
+                if pos == 'prepend':
+                    for child in reversed(children):
+                        node.insert(0, child)
+                elif pos in ['before', 'after'] and node.getparent() is not None:
+                    parent = node.getparent()
+                    at = parent.index(node) + (pos == 'after')
+                    for offset, child in enumerate(children):
+                        parent.insert(at + offset, child)
+                else:
+                    node.extend(children)
+                self.index = None
+            elif op.tag == 'remove' and attr is not None:
+                del node.attrib[attr]
+            elif op.tag == 'remove' and node.getparent() is not None:
+                node.getparent().remove(node)
+                self.index = None
+            else:
+                self.skipped += 1
+
+    def attributes(self, taglist, convert=True):
+        #Same result layout as parse_asset_file: attributes of the first element (in document
+        #order, below the root) of every tag, keyed by its lxml path plus the attribute name
         
-        #Export diff files
-        modified_engines.apply(lambda x: export_asset_xml_diff(outfilepath = x['fullpath_final'], 
-                                                               attributes = x[modified_engines_colmap.values()].to_dict()),
-                               axis=1)   
-    
-        #Validation
-        engines_fig = px.scatter(modified_engines, 
-                                 x='eff_boost_thrust', 
-                                 y='eff_travel_thrust', 
-                                 text='basefilename_vro_original')
-        engines_fig.update_traces(textposition='top center')
-        engines_fig.update_layout(
-                height=800,
-                title_text='Boost vs travel thrust'
-                )
-        engines_fig.show()
-        engines_fig.write_image(os.path.join(sum_outdir, 'modified_engines.png'))
-
-        engines_fig_s = px.scatter(modified_engines[modified_engines['size'].isin(['s'])], 
-                                 x='eff_boost_thrust', 
-                                 y='eff_travel_thrust', 
-                                 text='basefilename_vro_original')
-        engines_fig_s.update_traces(textposition='top center')
-        engines_fig_s.update_layout(
-                height=800,
-                title_text='Boost vs travel thrust, S ships'
-                )
-        engines_fig_s.show()
-        engines_fig_s.write_image(os.path.join(sum_outdir, 'modified_engines_s.png'))
-
-        modified_engines.to_csv(os.path.join(sum_outdir, 'modified_engines.csv'))    
-    
-    #--------------------------------------------------------------------------
\ No newline at end of file
+        result = {}
+        root = self.tree.getroot()
+        for tag in taglist:
+            elem = next(root.iterdescendants(str(tag)), None)
+            if elem is None:
+                continue
+            attr_path = self.tree.getpath(elem)
+            attr_dict = {str(attr_path) + '/' + str(k):v for k, v in elem.attrib.items()}
+            if convert:
+                attr_dict = {k:float(v) for k, v in attr_dict.items()}
+            result.update(attr_dict)
+        return(result)
+
+#------------------------------------------------------------------------------
+
+def resolve_overlay(chain, taglist, convert=True, collapse_diffs=True):
+    #Effective attributes of one asset after the game's overlay of its files
+    #
+    #chain: files (paths or CatalogEntry) of the asset in load order, see overlay_chains
+    #taglist, convert: see parse_asset_file
+    #collapse_diffs: how <diff> files are read that have no document to patch, see below
+    #
+    #A full document replaces whatever came before it, <diff> files are patched onto it.
+    #Diffs that precede any full document (e.g. patches of files outside the resources)
+    #are read on their own with parse_asset_file, as without overlays.
+
+    doc = None
+    loose = {}
+    for member in chain:
+        if isinstance(member, CatalogEntry):
+            data = read_catalog_entry(member)
+        else:
+            with open(member, 'rb') as infile:
+                data = infile.read()
+        root = etree.parse(io.BytesIO(data)).getroot()
+
+        if root.tag != 'diff':
+            doc = OverlayDocument(root)
+        elif doc is not None:
+            doc.apply(root)
+        else:
+            loose.update(parse_asset_file(io.BytesIO(data), taglist, convert=convert, collapse_diffs=collapse_diffs))
+
+    if doc is None:
+        return(loose)
+    return(doc.attributes(taglist, convert=convert))
+
+#------------------------------------------------------------------------------
+
+def overlay_chains(files, filelist, base='base'):
+    #Groups the listed files of every asset into the overlay chains the game loads
+    #
+    #files, filelist: see find_resource_files, rows in resource (load) order
+    #base: source of the game files every other source is overlaid on
+    #
+    #Files of the same name (case insensitive) are one asset.  Returns (assets, chains) with 
+    #one asset row per name and source, taken from the first file of that source, and the
+    #matching tuple of files to overlay: the base source files followed by the files of 
+    #the row's own source, in load order (see resolve_overlay).
+
+    by_name = collections.OrderedDict()
+    for pos, (name, source) in enumerate(zip(files.basefilename, files.source)):
+        by_name.setdefault(name.lower(), []).append((pos, source))
+
+    rows, chains = [], []
+    for members in by_name.values():
+        for source in collections.OrderedDict.fromkeys(s for p, s in members):
+            rows.append(next(p for p, s in members if s == source))
+            chains.append(tuple(filelist[p] for p, s in members if s == base or s == source))
+
+    order = np.argsort(rows, kind='stable')
+    assets = files.iloc[[rows[i] for i in order]].reset_index(drop=True)
+    return(assets, [chains[i] for i in order])
+
+#------------------------------------------------------------------------------
+
+def load_attribute_store(resources, asset_path, file_pattern, taglist, 
+                         executor='serial', max_workers=None, chunksize=1, cache=None, archives=False,
+                         overlay=False):
+    #Collects and parses relevant X4:Foundations asset files into an AttributeStore
+    #
+    #resources, asset_path, file_pattern, archives: see find_resource_files
+    #taglist: tags to extract from the identied input files
+    #executor, max_workers, chunksize: parallel parsing options, see parse_files
+    #cache: optional ParseCache or cache database path, see parse_files
+    #overlay: if True each asset holds its effective values after applying the <diff> patches
+    #         of all resources in load order (one asset per name and source, see overlay_chains)
+    #         instead of the values of every file read on its own
+
+    files, filelist = find_resource_files(resources, asset_path, file_pattern, archives=archives)
+    if overlay:
+        files, filelist = overlay_chains(files, filelist)
+    parsed = parse_files(filelist, taglist=taglist, executor=executor, 
+                         max_workers=max_workers, chunksize=chunksize, cache=cache, overlay=overlay)
+    
+    with stage('store') as record:
+        store = AttributeStore.from_parsed(files, parsed)
+        record['values'] = len(store.values)
+
+    return(store)
+
+#------------------------------------------------------------------------------
+
+def parse_resources(resources, asset_path, file_pattern, taglist, **parse_kwargs):
+    #Collects and parses relevant X4:Foundations asset files based upon input filters
+    #
+    #resources: pd.DataFrame of available input directories, contains resources root
+    #asset_path: path to relevant directory for the specific asset, relative to resource root
+    #file_pattern: regex pattern to id files in asset path to retain
+    #taglist: tags to extract from the identied input files
+    #parse_kwargs: executor, max_workers, chunksize, cache, archives, overlay (see load_attribute_store)
+    #
+    #Returns the wide layout: one row per file, one float column per attribute xpath
+
+    store = load_attribute_store(resources, asset_path, file_pattern, taglist, **parse_kwargs)
+        
+    return(store.to_frame())
+
+#------------------------------------------------------------------------------
+
+class AttributeStore(object):
+    #Compact long format table of asset attributes
+    #
+    #assets: pd.DataFrame, one row per asset (file) indexed by asset id; resource, source and
+    #        name metadata columns (race/size/type/mk) are held as categoricals
+    #asset_ids, attr_ids, values: equal length arrays, one entry per attribute value
+    #attributes: pd.Index of the interned attribute xpaths, attr_ids index into it
+    #
+    #Only the attributes a transform asks for are materialized as columns (pivot/join).
+
+    CATEGORICAL = ['resource', 'source', 'race', 'size', 'type', 'mk']
+
+    def __init__(self, assets, asset_ids, attr_ids, values, attributes):
+        self.assets = assets
+        for col in self.CATEGORICAL:
+            if col in assets.columns and not isinstance(assets[col].dtype, pd.CategoricalDtype):
+                assets[col] = assets[col].astype('category')
+                
+        self.asset_ids = np.asarray(asset_ids, dtype=np.int32)
+        self.attr_ids = np.asarray(attr_ids, dtype=np.int32)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.attributes = pd.Index(attributes, dtype=object)
+
+    @classmethod
+    def from_parsed(cls, files, parsed):
+        #files: one row per parsed file, parsed: matching list of xpath: value dicts
+        
+        interned = {}
+        asset_ids, attr_ids, values = [], [], []
+        for asset_id, attrs in enumerate(parsed):
+            for xpath, value in attrs.items():
+                asset_ids.append(asset_id)
+                attr_ids.append(interned.setdefault(xpath, len(interned)))
+                values.append(value)
+
+        return(cls(files.reset_index(drop=True), asset_ids, attr_ids, values, list(interned)))
+
+    @classmethod
+    def from_frame(cls, frame, columns, meta=None):
+        #Builds a store from wide columns
+        #
+        #frame: pd.DataFrame, one row per asset
+        #columns: dict of name: column holding the attribute values (the columns are interned
+        #         as attributes, e.g. modified_cols for transform results)
+        #meta: columns of frame to keep in the asset table
+        
+        assets = frame[list(meta or [])].reset_index(drop=True)
+        wide = frame[list(columns.values())].to_numpy(dtype=np.float64)
+        asset_ids = np.repeat(np.arange(len(assets)), wide.shape[1])
+        attr_ids = np.tile(np.arange(wide.shape[1]), len(assets))
+        
+        return(cls(assets, asset_ids, attr_ids, wide.ravel(), list(columns.values())))
+
+    def aliases(self, taglist):
+        #colname look up table, gives 'tag_attrib': xpath (last match wins, as for the wide layout)
+        cnm = {}
+        for tag in taglist:
+            colpattern = r'.*(/' + str(tag) + r'/).*'
+            cnm.update({str(tag)+'_'+str(c)[str(c).rfind('/')+1:] :c for c in self.attributes if re.match(colpattern, c)})
+        return(cnm)
+
+    def add_metadata(self, name_pattern, name_groups):
+        #Captures metadata (e.g. owner/size/type) from the file names as categorical columns
+        metadata = self.assets.basefilename.str.extract(name_pattern, expand=True)
+        for name, group in name_groups.items():
+            self.assets[name] = metadata[group].astype('category')
+        return(self)
+
+    def update(self, other, key='fullpath', removed=()):
+        #Replaces assets by their reparsed version and adds new ones
+        #
+        #other: AttributeStore of the (re)parsed assets, with the same asset table columns
+        #key: asset table column identifying an asset across stores
+        #removed: key values of assets to drop
+        #
+        #Returns the updated store, unchanged and replaced assets keep their asset ids
+
+        gone = self.assets[key].isin(list(other.assets[key]) + list(removed)).values
+        known = pd.Series(self.assets.index, index=self.assets[key].values)
+        ids = known.reindex(other.assets[key].values).values
+        new = np.isnan(ids)
+        start = self.assets.index.max() + 1 if len(self.assets) else 0
+        ids[new] = np.arange(start, start + new.sum())
+        ids = ids.astype(np.int64)
+
+        attributes = self.attributes.append(other.attributes[~other.attributes.isin(self.attributes)])
+        keep = ~np.isin(self.asset_ids, self.assets.index[gone])
+        other_assets = other.assets.set_axis(ids, axis=0)
+        
+        return(AttributeStore(pd.concat([self.assets[~gone], other_assets]).sort_index(),
+                              np.concatenate([self.asset_ids[keep], ids[other.assets.index.get_indexer(other.asset_ids)]]),
+                              np.concatenate([self.attr_ids[keep], attributes.get_indexer(other.attributes)[other.attr_ids]]),
+                              np.concatenate([self.values[keep], other.values]),
+                              attributes))
+
+    def has(self, xpath):
+        #Boolean per asset: does it carry a (non NaN) value for xpath
+        attr_id = self.attributes.get_loc(xpath)
+        entries = (self.attr_ids == attr_id) & ~np.isnan(self.values)
+        return(self.assets.index.isin(self.asset_ids[entries]))
+
+    def select(self, mask):
+        #Subset of the store for the assets where mask is True
+        assets = self.assets[np.asarray(mask)]
+        keep = np.isin(self.asset_ids, assets.index.values)
+        return(AttributeStore(assets, self.asset_ids[keep], self.attr_ids[keep], self.values[keep], self.attributes))
+
+    def pivot(self, columns=None, assets=None):
+        #Materializes attributes as wide columns next to the asset metadata
+        #
+        #columns: dict of output column name: xpath (default: every attribute under its xpath)
+        #assets: optional subset of asset ids (default: all)
+
+        if columns is None:
+            columns = {c:c for c in self.attributes}
+        frame = self.assets if assets is None else self.assets.loc[assets]
+
+        attr_pos = np.full(len(self.attributes), -1)
+        names = list(columns)
+        for i, xpath in enumerate(columns.values()):
+            if xpath in self.attributes:
+                attr_pos[self.attributes.get_loc(xpath)] = i
+        row_pos = frame.index.get_indexer(self.asset_ids)
+
+        keep = (attr_pos[self.attr_ids] >= 0) & (row_pos >= 0)
+        wide = np.full((len(frame), len(names)), np.nan)
+        wide[row_pos[keep], attr_pos[self.attr_ids[keep]]] = self.values[keep]
+
+        return(pd.concat([frame, pd.DataFrame(wide, index=frame.index, columns=names)], axis=1))
+
+    def join(self, on, columns, left='vro', right='base', suffixes=('_vro', '_base'), prepare=None):
+        #Pivots the left and right source assets and joins them on the metadata keys
+        #
+        #on: metadata join keys
+        #columns: dict of output column name: xpath to materialize
+        #left, right: source values to join (left join)
+        #prepare: optional callable applied to each pivoted side before the join
+
+        sides = []
+        for source in [left, right]:
+            side = self.pivot(columns, assets=self.assets.index[self.assets['source'] == source])
+            if prepare is not None:
+                side = prepare(side)
+            sides.append(side.rename_axis('asset_id').reset_index())
+
+        return(pd.merge(sides[0], sides[1], how='left', on=on, suffixes=list(suffixes)))
+
+    def to_frame(self):
+        #Wide layout: asset metadata plus one column per attribute xpath
+        return(self.pivot().reset_index(drop=True))
+
+    def records(self):
+        #Yields (asset id, {xpath: value}) per asset, in asset order
+        pos = self.assets.index.get_indexer(self.asset_ids)
+        order = np.argsort(pos, kind='stable')
+        bounds = np.flatnonzero(np.diff(pos[order])) + 1
+        for entries in np.split(order, bounds):
+            if len(entries):
+                yield((int(self.asset_ids[entries[0]]),
+                       {self.attributes[a]:v for a, v in zip(self.attr_ids[entries].tolist(), self.values[entries].tolist())}))
+
+    def __len__(self):
+        return(len(self.assets))
+
+#------------------------------------------------------------------------------
+
+def compute_group_factors(df, keys, factors):
+    #Computes mean ratio factors per group and attaches them to df in place
+    #
+    #df: pd.DataFrame to add the factor columns to
+    #keys: list of group key columns
+    #factors: dict of factor column name: (numerator column, denominator column)
+    #
+    #Same values as df.groupby(keys).apply(lambda x: (x[num] / x[den]).mean()) merged 
+    #back onto df, but all ratios are built in one vectorized pass and the group means 
+    #are broadcast straight back onto the rows (rows with a missing key get NaN).
+
+    ratios = pd.DataFrame({name: df[num] / df[den] for name, (num, den) in factors.items()}, index=df.index)
+    means = ratios.groupby([df[k] for k in keys]).transform('mean')
+    
+    for name in factors:
+        df[name] = means[name]
+
+    return(df)
+
+#------------------------------------------------------------------------------
+
+RULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules')
+
+def rules_file(rules):
+    #Path of the JSON file behind a rule config name or path (None for a loaded dict)
+
+    if isinstance(rules, dict):
+        return(None)
+
+    path = str(rules)
+    if not os.path.isfile(path):
+        path = os.path.join(RULES_DIR, os.path.splitext(path)[0] + '.json')
+    return(path)
+
+#------------------------------------------------------------------------------
+
+def load_rules(rules):
+    #Loads an asset rule config
+    #
+    #rules: path to a JSON rule file, the name of a file in RULES_DIR (e.g. 'engines'),
+    #       or an already loaded dict
+
+    if isinstance(rules, dict):
+        return(copy.deepcopy(rules))
+
+    with open(rules_file(rules), 'r') as infile:
+        return(json.load(infile))
+
+#------------------------------------------------------------------------------
+
+def _predicate_key(predicate):
+    #Canonical hashable form of a {column: [values]} or {column: {'not': [values]}} predicate
+    return(json.dumps(predicate, sort_keys=True))
+
+#------------------------------------------------------------------------------
+
+def _predicate_mask(df, predicate):
+    mask = pd.Series(True, index=df.index)
+    for col, values in predicate.items():
+        if isinstance(values, dict):
+            mask &= ~df[col].isin(values['not'])
+        else:
+            mask &= df[col].isin(values)
+    return(mask)
+
+#------------------------------------------------------------------------------
+
+class _Rule(object):
+    #One compiled balance rule
+    #
+    #target = expr on the rows matching all 'when' predicates (other rows keep their value), 
+    #then target = fallback wherever any 'fallback_when' predicate matches or target is NaN
+
+    def __init__(self, spec, position):
+        self.spec = spec
+        self.position = position
+        self.target = spec['target']
+        self.when = spec.get('when')
+        self.fallback_when = spec.get('fallback_when', [])
+        
+        self.expr = compile(str(spec['expr']), '<rule ' + self.target + '>', 'eval')
+        self.reads = self.names(spec['expr'])
+        if 'fallback' in spec:
+            self.fallback = compile(str(spec['fallback']), '<fallback ' + self.target + '>', 'eval')
+            self.reads |= self.names(spec['fallback'])
+        else:
+            self.fallback = None
+
+        self.predicates = ([self.when] if self.when else []) + list(self.fallback_when)
+        self.predicate_cols = set(col for pred in self.predicates for col in pred)
+
+    @staticmethod
+    def names(expr):
+        return(set(node.id for node in ast.walk(ast.parse(str(expr), mode='eval')) if isinstance(node, ast.Name)))
+
+#------------------------------------------------------------------------------
+
+class _RuleNamespace(object):
+    #Name lookup for rule expressions: tag_attrib aliases, plain columns, then params
+
+    def __init__(self, df, cnm, params):
+        self.df = df
+        self.cnm = cnm
+        self.params = params
+
+    def __getitem__(self, name):
+        col = self.cnm.get(name, name)
+        if col in self.df.columns:
+            return(self.df[col])
+        if name in self.params:
+            return(self.params[name])
+        raise KeyError(name)
+
+#------------------------------------------------------------------------------
+
+class RuleStage(object):
+    #Dependency ordered, pruned execution plan for a list of rules
+    #
+    #rules: list of rule specs (dicts with target, expr, and optional when, fallback, fallback_when)
+    #needed: names required after this stage, only rules feeding them are kept
+    #
+    #Rules writing the same target run in file order; a rule reading another target runs 
+    #after every rule writing it.  Predicate masks are built once per run.
+
+    def __init__(self, rules, needed):
+        compiled = [_Rule(spec, i) for i, spec in enumerate(rules)]
+
+        #keep only rules that (transitively) feed the needed names
+        needed = set(needed)
+        keep = set()
+        changed = True
+        while changed:
+            changed = False
+            for rule in compiled:
+                if rule.position not in keep and rule.target in needed:
+                    keep.add(rule.position)
+                    needed |= rule.reads | rule.predicate_cols
+                    changed = True
+        compiled = [rule for rule in compiled if rule.position in keep]
+
+        targets = set(rule.target for rule in compiled)
+        clashes = targets & set(col for rule in compiled for col in rule.predicate_cols)
+        if clashes:
+            raise ValueError('Rule predicates cannot use rule targets: ' + ', '.join(sorted(clashes)))
+
+        #dependency edges: same target in file order, readers after all writers of other targets
+        deps = {rule.position: set() for rule in compiled}
+        for rule in compiled:
+            for other in compiled:
+                if other.target == rule.target:
+                    if other.position < rule.position:
+                        deps[rule.position].add(other.position)
+                elif other.target in rule.reads:
+                    deps[rule.position].add(other.position)
+
+        self.rules = []
+        done = set()
+        while len(done) < len(compiled):
+            ready = [rule for rule in compiled if rule.position not in done and deps[rule.position] <= done]
+            if not ready:
+                raise ValueError('Circular rule dependencies between: ' + 
+                                 ', '.join(sorted(set(r.target for r in compiled if r.position not in done))))
+            self.rules.append(ready[0])
+            done.add(ready[0].position)
+
+        self.targets = targets
+        self.inputs = needed - targets
+        self.predicates = {_predicate_key(p):p for rule in self.rules for p in rule.predicates}
+
+    def run(self, df, cnm, params):
+        #Applies the rules to df in place, targets are resolved through cnm (tag_attrib: column)
+
+        masks = {key:_predicate_mask(df, pred) for key, pred in self.predicates.items()}
+        namespace = _RuleNamespace(df, cnm, params)
+        scope = {'__builtins__': {}}
+
+        for rule in self.rules:
+            col = cnm.get(rule.target, rule.target)
+            
+            values = eval(rule.expr, scope, namespace)
+            if not isinstance(values, pd.Series):
+                values = pd.Series(values, index=df.index, dtype=float)
+                
+            if rule.when:
+                current = df[col] if col in df.columns else pd.Series(float('nan'), index=df.index)
+                values = values.where(masks[_predicate_key(rule.when)], current)
+            df[col] = values
+
+            if rule.fallback is not None:
+                use_fallback = df[col].isna()
+                for pred in rule.fallback_when:
+                    use_fallback |= masks[_predicate_key(pred)]
+                df[col] = df[col].mask(use_fallback, eval(rule.fallback, scope, namespace))
+
+        return(df)
+
+#------------------------------------------------------------------------------
+
+def rank_match(df, by, sort, rank, match, columns=None, suffixes=('_original', '_ranked')):
+    #Pairs every row with the row holding the same rank of another column within its group
+    #
+    #by: group column (or list of columns)
+    #sort: column to presort by (within by), decides ties
+    #rank: (rank column name, column ranked) for the rows being matched
+    #match: (rank column name, column ranked) for the rows matched against
+    #columns: columns to take from the matched rows (default all, like a full self merge)
+    #
+    #Returns one row per pair: the row's own columns with the _original suffix (but 'by') 
+    #next to the matched row's columns with the _ranked suffix.  Same rows, order and values
+    #as merging the ranked frame with itself on by and rank == match, but the ranks are 
+    #argsort permutations per group and only the asked for columns of the partners are 
+    #gathered instead of duplicating the frame.
+
+    keys = list(by) if isinstance(by, (list, tuple)) else [by]
+    df = df.sort_values(keys + [sort])
+
+    #group number per row, missing keys form groups too (they only pair up via NaN ranks)
+    codes = np.column_stack([pd.factorize(df[k], use_na_sentinel=False)[0] for k in keys])
+    groups = np.unique(codes, axis=0, return_inverse=True)[1].reshape(-1)
+    valid_key = df[keys].notna().all(axis=1).values
+    position = np.arange(len(df))
+
+    def ranks(values):
+        #descending rank within the group, ties in frame order (rank method 'first'), and
+        #the row positions in (group, rank) order with the first position of every group
+        values = np.asarray(values, dtype=float)
+        valid = valid_key & ~np.isnan(values)
+        order = np.lexsort((position[valid], -values[valid], groups[valid]))
+        rows = position[valid][order]
+        starts = np.searchsorted(groups[rows], np.arange(groups.max() + 2 if len(groups) else 1))
+        rank = np.full(len(df), np.nan)
+        rank[rows] = np.arange(len(rows)) - starts[groups[rows]] + 1
+        return(rank, rows, starts)
+
+    own_rank, _, _ = ranks(df[rank[1]])
+    other_rank, other_rows, other_starts = ranks(df[match[1]])
+    df[rank[0]] = own_rank
+    df[match[0]] = other_rank
+
+    #rank k of a group pairs with the k-th row of the group in match order
+    left = np.flatnonzero(~np.isnan(own_rank))
+    at = other_starts[groups[left]] + own_rank[left].astype(np.int64) - 1
+    found = at < other_starts[groups[left] + 1]
+    left, right = left[found], other_rows[at[found]]
+
+    #rows without a rank pair with every row of the same keys without a match rank, as NaN 
+    #keys do in a merge, and like there all rows of such a key follow its first row (rare, 
+    #left to pandas)
+    if np.isnan(own_rank).any() and np.isnan(other_rank).any():
+        nan_pairs = pd.merge(pd.DataFrame({'g': groups, 'left': position})[np.isnan(own_rank)],
+                             pd.DataFrame({'g': groups, 'right': position})[np.isnan(other_rank)], on='g')
+        first = nan_pairs.groupby('g')['left'].transform('min').values
+        order = np.lexsort((np.concatenate([left, nan_pairs['left'].values]), 
+                            np.concatenate([left, first])))
+        left = np.concatenate([left, nan_pairs['left'].values])[order]
+        right = np.concatenate([right, nan_pairs['right'].values])[order]
+
+    columns = [c for c in (df.columns if columns is None else columns) if c not in keys]
+    original = df.take(left).reset_index(drop=True)
+    original.columns = [c if c in keys else str(c) + suffixes[0] for c in original.columns]
+    ranked = df[columns].take(right).reset_index(drop=True)
+    ranked.columns = [str(c) + suffixes[1] for c in columns]
+    
+    return(pd.concat([original, ranked], axis=1))
+
+#------------------------------------------------------------------------------
+
+def _suffix_variants(names, suffixes):
+    #All names plus the names with any chain of the given suffixes removed
+    result = set(names)
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        for suffix in suffixes:
+            if name.endswith(suffix) and name[:-len(suffix)] not in result:
+                result.add(name[:-len(suffix)])
+                pending.append(name[:-len(suffix)])
+    return(result)
+
+#------------------------------------------------------------------------------
+
+def _scenario_params(df, run_params):
+    #Rule params for a frame of stacked scenarios (df.scenario indexes run_params): values 
+    #shared by all scenarios stay scalars, the others become per row Series
+
+    params = {}
+    for name in set(k for p in run_params for k in p):
+        values = [p.get(name, float('nan')) for p in run_params]
+        if all(v == values[0] for v in values):
+            params[name] = values[0]
+        else:
+            params[name] = pd.Series(np.asarray(values, dtype=float)[df['scenario'].values], index=df.index)
+    return(params)
+
+#------------------------------------------------------------------------------
+
+class AssetRules(object):
+    #Compiled asset transform built from a rule config (see rules/*.json)
+    #
+    #Config keys:
+    #asset_path, file_pattern, taglist: parse_resources inputs
+    #name_pattern, name_groups: regex on the file name and the group numbers holding metadata
+    #match_on: metadata columns joining vro assets to their base counterparts
+    #require: tag_attribs that must be present for an asset to be kept
+    #params: named constants usable in expressions
+    #derive: rules run on each source before the vro/base merge
+    #factors: name: {by, num, den} mean ratio factors (see compute_group_factors)
+    #rules: rules run on the merged frame
+    #rank_match: optional {by, sort, rank, match} step (see rank_match)
+    #final_rules: rules run after rank_match
+    #export: tag_attribs written to the diff files, keep: extra columns to compute
+
+    SUFFIXES = ['_vro', '_base', '_original', '_ranked']
+
+    def __init__(self, rules, **overrides):
+        self.config = load_rules(rules)
+        self.config.update({k:v for k, v in overrides.items() if v is not None})
+        
+        config = self.config
+        self.params = dict(config.get('params', {}))
+        self.export = list(config['export'])
+
+        #plan backwards from the exported attributes
+        needed = set(self.export) | set(config.get('keep', []))
+        self.final_stage = RuleStage(config.get('final_rules', []), needed)
+        needed = _suffix_variants(self.final_stage.inputs, self.SUFFIXES)
+
+        #the only columns rank_match takes from the matched rows
+        used = set(self.final_stage.inputs)
+        for spec in config.get('reports', []):
+            used |= set([spec['x'], spec['y'], spec['text']]) | set(spec.get('where', {}))
+        self.ranked = sorted(name[:-len('_ranked')] for name in used if name.endswith('_ranked'))
+        
+        rank = config.get('rank_match')
+        if rank:
+            needed |= set([rank['sort'], rank['rank'][1], rank['match'][1]])
+        self.rules_stage = RuleStage(config.get('rules', []), needed)
+        needed = _suffix_variants(self.rules_stage.inputs, self.SUFFIXES) | needed
+        
+        self.factors = {name:spec for name, spec in config.get('factors', {}).items() if name in needed}
+        needed |= set(spec[k] for spec in self.factors.values() for k in ['num', 'den'])
+        needed = _suffix_variants(needed, self.SUFFIXES)
+        self.derive_stage = RuleStage(config.get('derive', []), needed)
+        
+        #attribute names the transform reads, only these are materialized from the store
+        self.inputs = _suffix_variants(needed | self.derive_stage.inputs, self.SUFFIXES)
+        self.inputs |= set(config.get('require', []))
+
+        #metadata columns every grouping step (join, factors, rank_match) splits on: assets 
+        #differing in them never influence each other's results, see AssetWatch
+        keys = set(config['match_on'])
+        for spec in self.factors.values():
+            keys &= set(spec['by'])
+        if rank:
+            keys &= set([rank['by']])
+        self.partition_keys = [k for k in config['match_on'] if k in keys]
+
+        computed = self.final_stage.targets | self.rules_stage.targets
+        missing = [name for name in self.export if name not in computed]
+        if missing:
+            raise ValueError('Exported attributes need a rule: ' + ', '.join(missing))
+
+    def run(self, resources, params=None, **parse_kwargs):
+        #Parses the resources and applies the transform
+        #
+        #resources: pd.DataFrame of available input directories, contains resources root,
+        #           or an AttributeStore that was already loaded for this config
+        #params: optional overrides of the config params
+        #parse_kwargs: passed through to load_attribute_store
+        #
+        #Returns (modified, modified_cols) with modified_cols mapping exported tag_attrib: xpath column
+
+        if isinstance(resources, AttributeStore):
+            store = resources
+        else:
+            store = self.load(resources, **parse_kwargs)
+
+        with stage('transform'):
+            return(self.transform(store, params=params))
+
+    def load(self, resources, **parse_kwargs):
+        #Parses the resources into an AttributeStore with the name metadata attached
+
+        config = self.config
+        store = load_attribute_store(resources=resources, asset_path=config['asset_path'], 
+                                     file_pattern=config['file_pattern'], taglist=config['taglist'], 
+                                     **parse_kwargs)
+
+        #capture owner/size/type from filename
+        return(store.add_metadata(config['name_pattern'], config['name_groups']))
+
+    def transform(self, store, params=None):
+        #Applies the transform to a loaded AttributeStore, see run
+
+        return(self.transform_scenarios(store, {None: params})[None])
+
+    def transform_scenarios(self, store, scenarios):
+        #Applies the transform for several parameter sets at once
+        #
+        #store: AttributeStore loaded for this config (see load)
+        #scenarios: dict of scenario name: params overrides (None for the config params)
+        #
+        #The vro/base join and the group factors are built once (once per distinct value of 
+        #the params the derive rules read) and every scenario is stacked onto one frame along
+        #a scenario axis: the rules run once over all of them with the params that differ 
+        #between scenarios as per row values, and rank_match pairs rows within their scenario.
+        #Returns dict of scenario name: (modified, modified_cols)
+
+        config = self.config
+        names = list(scenarios)
+        run_params = []
+        for name in names:
+            params = dict(self.params)
+            params.update(scenarios[name] or {})
+            run_params.append(params)
+
+        #gives 'tag_attrib': xpath, only the attributes the rules read are pivoted
+        aliases = store.aliases(config['taglist'])
+
+        with stage('join', scenarios=len(names)) as record:
+            #Further filter observations to those with all required attributes
+            for name in config.get('require', []):
+                store = store.select(store.has(aliases[name]))
+
+            #scenarios agreeing on the params read before the join share it
+            derive_reads = set(name for rule in self.derive_stage.rules for name in rule.reads)
+            derive_keys = sorted(set(k for params in run_params for k in params) & derive_reads)
+            shared = collections.OrderedDict()
+            for pos, params in enumerate(run_params):
+                shared.setdefault(tuple(params.get(k) for k in derive_keys), []).append(pos)
+
+            columns = {name:xpath for name, xpath in aliases.items() if name in self.inputs}
+            joins = []
+            for positions in shared.values():
+                def derive(side):
+                    self.derive_stage.run(side, {}, run_params[positions[0]])
+                    return(side)
+
+                joined = store.join(on=config['match_on'], columns=columns, left='vro', right='base', 
+                                    suffixes=('_vro', '_base'), prepare=derive)
+                joins.append((joined, positions))
+            record.update(assets=len(store), rows=len(joins[0][0]), columns=len(columns), joins=len(joins))
+
+        #modify values
+        with stage('factors', factors=len(self.factors)):
+            factor_groups = {}
+            for name, spec in self.factors.items():
+                factor_groups.setdefault(tuple(spec['by']), {})[name] = (spec['num'], spec['den'])
+            for joined, positions in joins:
+                for keys, factors in factor_groups.items():
+                    compute_group_factors(joined, keys=list(keys), factors=factors)
+
+        modified = pd.concat([joined.assign(scenario=pos) for joined, positions in joins for pos in positions], 
+                             ignore_index=True)
+
+        with stage('rules', rules=len(self.rules_stage.rules)):
+            self.rules_stage.run(modified, {}, _scenario_params(modified, run_params))
+
+        rank = config.get('rank_match')
+        if rank:
+            with stage('rank_match') as record:
+                modified = rank_match(modified, by=['scenario', rank['by']], sort=rank['sort'], rank=rank['rank'], 
+                                      match=rank['match'], columns=[c for c in self.ranked if c in modified.columns])
+                record.update(rows=len(modified), ranked=len(self.ranked))
+
+        with stage('final_rules', rules=len(self.final_stage.rules)):
+            self.final_stage.run(modified, {}, _scenario_params(modified, run_params))
+
+        #exported values go back under their xpath
+        modified_cols = {name:aliases[name] for name in self.export}
+        modified = modified.rename(columns={name:xpath for name, xpath in modified_cols.items()})
+
+        results = {}
+        positions = modified.groupby('scenario').indices
+        modified = modified.drop(columns='scenario')
+        for pos, name in enumerate(names):
+            rows = modified.take(positions[pos]) if len(names) > 1 else modified
+            results[name] = (rows.reset_index(drop=True), modified_cols)
+
+        return(results)
+
+#------------------------------------------------------------------------------
+
+def update_assets(resources, rules, params=None, **parse_kwargs):
+    #Identifies and modifies X4: Foundations asset files according to a rule config
+    #
+    #resources: pd.DataFrame of available input directories, contains resources root
+    #rules: rule config (path, name in RULES_DIR or dict), see AssetRules
+    #params: optional overrides of the config params
+    #parse_kwargs: passed through AssetRules.run to load_attribute_store (executor, max_workers, 
+    #              chunksize, cache, archives, overlay)
+
+    return(AssetRules(rules).run(resources, params=params, **parse_kwargs))
+
+#------------------------------------------------------------------------------
+
+def update_shields(resources, asset_path=None, file_pattern=None, taglist=None, 
+                   rules='shields', params=None, **parse_kwargs):
+    #Identifies and modified X4: Foundations shield files
+    #
+    #resources: pd.DataFrame of available unpacked input directories, contains resources root
+    #asset_path: path to relevant directory for the specific asset, relative to resource root
+    #file_pattern: regex pattern to id files in asset path to retain
+    #taglist: tags to extract from the identied input files    
+    #rules: shield rule config, asset_path/file_pattern/taglist default to its values
+    #params: optional overrides of the rule params
+    #parse_kwargs: passed through AssetRules.run to load_attribute_store (executor, max_workers, 
+    #              chunksize, cache, archives, overlay)
+    
+    asset_rules = AssetRules(rules, asset_path=asset_path, file_pattern=file_pattern, taglist=taglist)
+    return(asset_rules.run(resources, params=params, **parse_kwargs))
+
+#------------------------------------------------------------------------------
+
+def update_engines(resources, asset_path=None, file_pattern=None, taglist=None, 
+                   rules='engines', params=None, **parse_kwargs):
+    #Identifies and modified X4: Foundations engine files
+    #
+    #resources: pd.DataFrame of available unpacked input directories, contains resources root
+    #asset_path: path to relevant directory for the specific asset, relative to resource root
+    #file_pattern: regex pattern to id files in asset path to retain
+    #taglist: tags to extract from the identied input files    
+    #rules: engine rule config, asset_path/file_pattern/taglist default to its values
+    #params: optional overrides of the rule params
+    #parse_kwargs: passed through AssetRules.run to load_attribute_store (executor, max_workers, 
+    #              chunksize, cache, archives, overlay)
+    
+    asset_rules = AssetRules(rules, asset_path=asset_path, file_pattern=file_pattern, taglist=taglist)
+    return(asset_rules.run(resources, params=params, **parse_kwargs))
+
+#==============================================================================
+
+#Defaults for the command line entry point, any key can be overridden by a JSON config file
+DEFAULT_CONFIG = {
+    #Summary output directory (summary tables, reports, parse cache, export manifests)
+    'summary_dir': '.',
+    
+    #Resource roots in load order (unpacked directories, or archive roots with parse.archives),
+    #null roots are asked for interactively unless running headless.  VRO overlay roots of the 
+    #expansions are derived from the vro_base root when not listed.
+    'resources': {'base': 'F:/Games/Mods/x4_extracted',
+                  'split': 'F:/Games/Mods/x4_extracted/extensions/ego_dlc_split',
+                  'terran': 'F:/Games/Mods/x4_extracted/extensions/ego_dlc_terran',
+                  'vro_base': 'F:/Games/Mods/x4_extracted/extensions/vro'},
+    
+    #Asset classes to modify (rule config name or path): output (mod) directory
+    'assets': {'shields': 'F:/Steam/steamapps/common/X4 Foundations/extensions/al_shieldmod_vro',
+               'engines': 'F:/Steam/steamapps/common/X4 Foundations/extensions/al_travelmod_vro'},
+    
+    #Parsing options, see load_attribute_store (cache is relative to summary_dir)
+    'parse': {'executor': 'process', 'max_workers': None, 'chunksize': 16, 
+              'cache': 'x4_parse_cache.sqlite', 'archives': False, 'overlay': True},
+    
+    #Validation reports: build them at all, open them in the browser, write image files as png 
+    #(kaleido, slow) or html (self-contained plotly page).  Reports and summary tables are 
+    #rendered after the diff export in a 'serial', 'thread' or 'process' pool, unchanged ones 
+    #are skipped (hashes in x4_report_cache.json).
+    'report': True,
+    'show': True,
+    'images': True,
+    'image_format': 'png',
+    'report_executor': 'process',
+    
+    #modified_<asset> summary table format: csv, parquet (fastest, needs pyarrow) or html
+    'summary_format': 'csv',
+    
+    #Mod output: pack the diffs into ext_01.cat/.dat archives (per mod and per extensions/<dlc>
+    #directory in it), false writes loose xml files
+    'packed': True,
+    
+    #Balance variants: scenario name: params overriding the rule config params (e.g. 
+    #{"slow_delay": {"recharge_delay_factor": 2.0}}), null for a single run with the config params
+    'scenarios': None,
+    
+    #Run report x4_run_report.json (per stage timing/memory, always written): also trace 
+    #allocations and profile the run (slower, writes x4_run_report.prof)
+    'profile': False
+    }
+
+#------------------------------------------------------------------------------
+
+def ask_directory(title):
+    #Asks for a directory with a Tk dialog (tkinter is only imported when needed)
+    
+    import tkinter as tk
+    from tkinter import filedialog
+    
+    root = tk.Tk()
+    root.withdraw()
+    try:
+        return(filedialog.askdirectory(title=title) or None)
+    finally:
+        root.destroy()
+
+#------------------------------------------------------------------------------
+
+def build_resources(roots, ask=None):
+    #Builds the resources table used by the parsing functions
+    #
+    #roots: dict of resource name: root directory (None if unknown), in load order
+    #ask: optional callable(title) returning a root for the unknown ones, else they raise
+    #
+    #Resources named vro_* are VRO overlays (source 'vro'), the others base game ('base').
+    #For every expansion without its own vro_ entry the overlay is expected below the 
+    #vro_base root in extensions/<expansion directory name>.
+
+    roots = dict(roots)
+    
+    #Gather inputs for all expansions interactively if not given
+    for grp, root in roots.items():
+        if not root:
+            if ask is None:
+                raise ValueError('No root directory given for resource: ' + str(grp))
+            roots[grp] = ask(str(grp) + ' dir')
+            if not roots[grp]:
+                raise ValueError('No root directory selected for resource: ' + str(grp))
+
+    #provide paths to vro expansion files given base game expansions
+    for grp in list(roots):
+        vro_grp = 'vro_' + str(grp)
+        if (grp not in ['base', 'vro_base']) and not grp.startswith('vro_') and (vro_grp not in roots) and ('vro_base' in roots):
+            roots[vro_grp] = os.path.join(roots['vro_base'], 'extensions', os.path.split(os.path.normpath(roots[grp]))[1])
+
+    resources = pd.DataFrame(list(roots.items()), columns=['resource', 'root'])
+    
+    #Set source base vs vro input metadata
+    resources['source'] = 'base'                                          
+    resources.loc[resources.resource.str.contains(r'^vro_.*'), 'source'] = 'vro'
+
+    return(resources)
+
+#------------------------------------------------------------------------------
+
+def report_frame(modified, modified_cols, spec):
+    #Plotted data of a validation report: (frame, x, y) with only the spec's columns and rows
+    #
+    #modified, modified_cols: transform result, see AssetRules.run
+    #spec: dict with name, x, y, text, title and an optional where predicate 
+    #      (x/y may be exported tag_attribs, they are resolved through modified_cols)
+
+    frame = modified
+    if spec.get('where'):
+        frame = frame[_predicate_mask(frame, spec['where'])]
+
+    x = modified_cols.get(spec['x'], spec['x'])
+    y = modified_cols.get(spec['y'], spec['y'])
+    frame = frame[list(dict.fromkeys([x, y, spec['text']]))]
+
+    return((frame, x, y))
+
+#------------------------------------------------------------------------------
+
+def render_figure(frame, x, y, text, title, outfilepath=None, show=False):
+    #Builds a validation scatter plot and writes/shows it (plotly is only imported here)
+    #
+    #frame, x, y: plotted data, see report_frame
+    #text, title: point label column and figure title
+    #outfilepath: .html writes a self-contained page (plotly.js inlined, fast), any other 
+    #             extension an image through kaleido (slow), None writes nothing
+    #show: open the figure in the browser
+    #
+    #Top level (picklable) so ReportWriter can run it in a process pool
+
+    import plotly.io as pio
+    import plotly.express as px
+    
+    pio.renderers.default = 'browser'
+
+    fig = px.scatter(frame, x=x, y=y, text=text)
+    fig.update_traces(textposition='top center')
+    fig.update_layout(
+            height=800,
+            title_text=title
+            )
+    
+    if show:
+        fig.show()
+    if outfilepath is not None:
+        tmppath = outfilepath + '.' + str(os.getpid()) + '.tmp'
+        try:
+            if outfilepath.endswith('.html'):
+                fig.write_html(tmppath, include_plotlyjs=True, full_html=True)
+            else:
+                fig.write_image(tmppath, format=os.path.splitext(outfilepath)[1][1:])
+            os.replace(tmppath, outfilepath)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
+    return(fig)
+
+#------------------------------------------------------------------------------
+
+def validation_report(modified, modified_cols, spec, outdir, show=True, image=True, image_format='png'):
+    #Scatter plot of a transform result, rendered right away (see ReportWriter for the pooled, 
+    #cached variant the pipeline uses)
+    #
+    #modified, modified_cols, spec: see report_frame
+    #outdir: directory for the <name>.<image_format> image
+    #show: open the figure in the browser
+    #image: write the image (png needs kaleido, html does not)
+
+    frame, x, y = report_frame(modified, modified_cols, spec)
+    outfilepath = os.path.join(outdir, str(spec['name']) + '.' + image_format) if image else None
+
+    with stage('figure', points=len(frame)):
+        return(render_figure(frame, x, y, spec['text'], spec['title'], outfilepath, show=show))
+
+#------------------------------------------------------------------------------
+
+def write_summary_table(frame, outfilepath):
+    #Writes a transform result summary, the format follows the extension
+    #
+    #.csv: plain text (slowest for large frames)
+    #.parquet: columnar binary, fastest to write and read back (needs pyarrow or fastparquet)
+    #.html: self-contained table page
+
+    tmppath = outfilepath + '.' + str(os.getpid()) + '.tmp'
+    ext = os.path.splitext(outfilepath)[1]
+    try:
+        if ext == '.parquet':
+            frame.to_parquet(tmppath)
+        elif ext == '.html':
+            with open(tmppath, 'w', encoding='utf-8') as outfile:
+                outfile.write('<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>' + 
+                              os.path.basename(outfilepath) + '</title></head>\n<body>\n')
+                frame.to_html(outfile)
+                outfile.write('\n</body>\n</html>\n')
+        elif ext == '.csv':
+            frame.to_csv(tmppath)
+        else:
+            raise ValueError('Unknown summary format: ' + str(ext))
+        os.replace(tmppath, outfilepath)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+#------------------------------------------------------------------------------
+
+def asset_label(name):
+    #File name stem and display label of an asset class key (rule config name or path), 
+    #e.g. 'shields' for shields and for rules/shields.json
+
+    return(os.path.splitext(os.path.basename(os.path.normpath(str(name))))[0])
+
+#------------------------------------------------------------------------------
+
+def summary_table_path(sum_outdir, name, summary_format='csv'):
+    #Path of the modified_<label> summary table of an asset class (see asset_label), 
+    #summary_format: csv, parquet or html
+    #(html tables are .table.html, apart from html report figures of the same name)
+
+    extensions = {'csv': '.csv', 'parquet': '.parquet', 'html': '.table.html'}
+    if summary_format not in extensions:
+        raise ValueError('Unknown summary format: ' + str(summary_format))
+
+    return(os.path.join(sum_outdir, 'modified_' + asset_label(name) + extensions[summary_format]))
+
+#------------------------------------------------------------------------------
+
+def _frame_digest(frame, settings):
+    #sha1 of a frame's labels and values plus the json-able settings it is rendered with
+
+    digest = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode('utf-8'))
+    digest.update(json.dumps([str(c) for c in frame.columns]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(frame, index=True).values.tobytes())
+
+    return(digest.hexdigest())
+
+#------------------------------------------------------------------------------
+
+class ReportWriter(object):
+    #Validation figures and summary tables, rendered in a worker pool after the diff export
+    #
+    #sum_outdir: summary directory, holds the x4_report_cache.json of rendered input hashes
+    #executor, max_workers: 'serial', 'thread' or 'process' pool, see parse_files
+    #
+    #add_figure/add_table only queue a job with the hash of its input data, nothing renders 
+    #before run().  Outputs whose hash matches the cache and whose file still exists are 
+    #skipped, so an unchanged balance pass re-renders nothing.
+
+    CACHE = 'x4_report_cache.json'
+
+    def __init__(self, sum_outdir, executor='process', max_workers=None):
+        self.cachepath = os.path.join(sum_outdir, self.CACHE)
+        self.executor = executor
+        self.max_workers = max_workers
+        self.jobs = []
+
+    def add_figure(self, modified, modified_cols, spec, outdir, image=True, image_format='png', show=False):
+        #Queues the figure of one report spec, see validation_report
+        
+        frame, x, y = report_frame(modified, modified_cols, spec)
+        outfilepath = os.path.join(outdir, str(spec['name']) + '.' + image_format) if image else None
+        self.jobs.append((outfilepath, _frame_digest(frame, [spec, image_format]), show, 
+                          render_figure, (frame, x, y, spec['text'], spec['title'])))
+
+    def add_table(self, frame, outfilepath):
+        #Queues a summary table, see write_summary_table
+        
+        self.jobs.append((outfilepath, _frame_digest(frame, os.path.splitext(outfilepath)[1]), False, 
+                          write_summary_table, (frame,)))
+
+    def run(self):
+        #Renders the queued jobs that are out of date, returns the rendered/skipped counts
+        
+        cache = {}
+        if os.path.exists(self.cachepath):
+            with open(self.cachepath, 'r') as infile:
+                cache = json.load(infile)
+
+        todo = []
+        skipped = 0
+        for outfilepath, digest, show, func, args in self.jobs:
+            current = outfilepath is None or (cache.get(os.path.abspath(outfilepath)) == digest and 
+                                              os.path.exists(outfilepath))
+            if current and not show:
+                skipped += 1
+                continue
+            #shown figures are rebuilt, their file is only rewritten when stale
+            kwargs = {'show': True} if show else {}
+            todo.append((None if current else outfilepath, digest, func, args, kwargs))
+        self.jobs = []
+
+        if self.executor == 'serial' or len(todo) <= 1:
+            pool = None
+        elif self.executor == 'thread':
+            pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        elif self.executor == 'process':
+            pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        else:
+            raise ValueError('Unknown executor: ' + str(self.executor))
+
+        error = None
+        with (pool or contextlib.nullcontext()):
+            if pool is None:
+                futures = [None] * len(todo)
+            else:
+                futures = [pool.submit(func, *args, outfilepath, **kwargs) 
+                           for outfilepath, digest, func, args, kwargs in todo]
+            for future, (outfilepath, digest, func, args, kwargs) in zip(futures, todo):
+                try:
+                    if future is None:
+                        func(*args, outfilepath, **kwargs)
+                    else:
+                        future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if outfilepath is not None:
+                    cache[os.path.abspath(outfilepath)] = digest
+
+        _write_atomic(self.cachepath, json.dumps(cache, indent=1, sort_keys=True))
+        if error is not None:
+            raise error
+
+        return({'rendered': len(todo), 'skipped': skipped})
+
+#------------------------------------------------------------------------------
+
+def run_pipeline(config, gui=True):
+    #Runs the full parse -> transform -> diff export -> report pipeline
+    #
+    #config: dict with the DEFAULT_CONFIG keys
+    #gui: allow Tk dialogs for missing roots and opening reports in the browser
+    #
+    #Returns dict of asset name (or (asset name, scenario) with config scenarios): 
+    #(modified, modified_cols, export report)
+    #
+    #With scenarios every asset class is parsed once and all scenarios are transformed
+    #together (see AssetRules.transform_scenarios).  Each scenario gets its own mod directory
+    #(see scenario_outdir) and summary directory summary_dir/<scenario>, reports are written 
+    #there but not opened.
+    #
+    #The diffs of every asset class (and scenario) are exported first, the validation figures 
+    #and summary tables are only rendered afterwards in a ReportWriter pool and skipped when 
+    #their input data is unchanged since the last run.
+    #
+    #The per stage timings/memory are written to x4_run_report.json in the summary directory
+    #and printed as a table.
+
+    report = RunReport(deep=config.get('profile', False))
+    with recording(report):
+        results = _run_pipeline(config, gui)
+    
+    report.write(os.path.join(config['summary_dir'], 'x4_run_report.json'))
+    print(report.summary())
+
+    return(results)
+
+#------------------------------------------------------------------------------
+
+def _pipeline_inputs(config, gui):
+    #Summary directory, resources table and parse options of a pipeline config
+
+    sum_outdir = config['summary_dir']
+    os.makedirs(sum_outdir, exist_ok=True)
+
+    parse_kwargs = dict(config.get('parse', {}))
+    if parse_kwargs.get('cache'):
+        parse_kwargs['cache'] = ParseCache(os.path.join(sum_outdir, parse_kwargs['cache']))
+    else:
+        parse_kwargs.pop('cache', None)
+
+    resources = build_resources(config['resources'], ask=ask_directory if gui else None)
+    
+    return(sum_outdir, resources, parse_kwargs)
+
+#------------------------------------------------------------------------------
+
+def export_modified(modified, modified_cols, name, resources, outdir, sum_outdir, scope=None, packed=False):
+    #Exports the diff files of a transform result into the mod directory outdir
+    #
+    #Output files mirror the vro asset files with the vro_base root swapped for outdir (kept
+    #in modified['fullpath_final']), the export manifest is sum_outdir/x4_<label>_manifest.json
+    #(see asset_label).
+    #scope: see export_asset_diffs
+    #packed: pack the diffs into ext_01.cat/.dat archives rather than loose files (loose 
+    #        output drops the asset class's entries from archives of an earlier packed run)
+
+    vro_root = resources.loc[resources.resource == 'vro_base', 'root'].values[0]
+    source_col = 'fullpath_vro_original' if 'fullpath_vro_original' in modified.columns else 'fullpath_vro'
+    modified['fullpath_final'] = modified[source_col].str.replace(vro_root, outdir, regex=False)
+        
+    diffs = AttributeStore.from_frame(modified, modified_cols, meta=['fullpath_final'])
+    return(export_asset_diffs(diffs, path_col='fullpath_final', scope=scope, packed=outdir if packed else None,
+                              modroot=outdir, manifest=os.path.join(sum_outdir, 'x4_' + asset_label(name) + '_manifest.json')))
+
+#------------------------------------------------------------------------------
+
+def _run_pipeline(config, gui):
+    #Pipeline body of run_pipeline, run while its RunReport is recording
+
+    sum_outdir, resources, parse_kwargs = _pipeline_inputs(config, gui)
+
+    scenarios = config.get('scenarios')
+    for scenario, params in (scenarios or {}).items():
+        os.makedirs(os.path.join(sum_outdir, str(scenario)), exist_ok=True)
+        with open(os.path.join(sum_outdir, str(scenario), 'scenario.json'), 'w') as outfile:
+            json.dump(params or {}, outfile, indent=1, sort_keys=True)
+
+    writer = ReportWriter(sum_outdir, executor=config.get('report_executor', 'process'))
+    results = {}
+    for name, outdir in config['assets'].items():
+        with stage(asset_label(name)):
+            asset_rules = AssetRules(name)
+            if not scenarios:
+                modified, modified_cols = asset_rules.run(resources, **parse_kwargs)
+                results[name] = _finish_asset(config, gui, writer, asset_rules, modified, modified_cols, name, 
+                                              resources, outdir, sum_outdir, asset_label(name))
+                continue
+            
+            #one parse and join, every scenario into its own mod directory and summary directory
+            store = asset_rules.load(resources, **parse_kwargs)
+            with stage('transform', scenarios=len(scenarios)):
+                variants = asset_rules.transform_scenarios(store, scenarios)
+            for scenario, (modified, modified_cols) in variants.items():
+                with stage(scenario):
+                    results[(name, scenario)] = _finish_asset(config, False, writer, asset_rules, modified, modified_cols, 
+                                                              name, resources, scenario_outdir(outdir, scenario), 
+                                                              os.path.join(sum_outdir, str(scenario)), 
+                                                              asset_label(name) + ' [' + str(scenario) + ']')
+
+    #all diffs are in place, render the reports
+    with stage('report', jobs=len(writer.jobs)) as record:
+        record.update(writer.run())
+
+    return(results)
+
+#------------------------------------------------------------------------------
+
+def scenario_outdir(outdir, scenario):
+    #Mod output directory of a scenario: a sibling of outdir suffixed with the scenario name
+    return(os.path.normpath(outdir) + '_' + str(scenario))
+
+#------------------------------------------------------------------------------
+
+def _finish_asset(config, gui, writer, asset_rules, modified, modified_cols, name, resources, outdir, sum_outdir, label):
+    #Diff export of one transform result, its validation reports and summary table are queued on writer
+
+    #Export diff files
+    export_report = export_modified(modified, modified_cols, name, resources, outdir, sum_outdir, 
+                                    packed=config.get('packed', False))
+    print(label + ' diffs: {written} written, {skipped} unchanged, {removed} removed'.format(**export_report))
+
+    #Validation
+    if config.get('report', True):
+        for spec in asset_rules.config.get('reports', []):
+            writer.add_figure(modified, modified_cols, spec, sum_outdir, image=config.get('images', True), 
+                              image_format=config.get('image_format', 'png'), show=gui and config.get('show', True))
+
+    writer.add_table(modified, summary_table_path(sum_outdir, name, config.get('summary_format', 'csv')))
+    
+    return((modified, modified_cols, export_report))
+
+#------------------------------------------------------------------------------
+
+def _file_signature(path):
+    #(mtime, size) of a file, None if it does not exist
+    try:
+        info = os.stat(path)
+    except OSError:
+        return(None)
+    return((info.st_mtime_ns, info.st_size))
+
+#------------------------------------------------------------------------------
+
+def _key_mask(frame, keys, values):
+    #Boolean per row: is the tuple of the key columns one of values
+    index = pd.MultiIndex.from_frame(frame[keys].astype(object))
+    return(np.asarray(index.isin(list(values))))
+
+#------------------------------------------------------------------------------
+
+class AssetWatch(object):
+    #Keeps the diff export of one asset class up to date with its resource files
+    #
+    #name: rule config name (or path), outdir: mod output directory
+    #resources, sum_outdir, packed, parse_kwargs: see export_modified and load_attribute_store
+    #
+    #poll() compares the size/mtime of the watched asset files with the last look.  Assets
+    #with a changed or new file (in their overlay chain, with parse overlay) are reparsed 
+    #into the AttributeStore, vanished ones dropped, and only the assets sharing the 
+    #AssetRules.partition_keys values (e.g. size and mk) of a changed file are transformed
+    #again and exported.  A changed rule file is recompiled and the whole 
+    #store transformed again (reparsed if the parsing inputs changed).  Packed roots 
+    #(archives) are watched through their .cat/.dat files and reloaded as a whole.
+
+    #config keys that decide what gets parsed, see AssetRules.load
+    LOAD_KEYS = ['asset_path', 'file_pattern', 'taglist', 'name_pattern', 'name_groups']
+
+    #changes up to this many files are parsed in process, a worker pool costs more than it saves
+    SERIAL_FILES = 64
+
+    def __init__(self, name, outdir, resources, sum_outdir, packed=False, **parse_kwargs):
+        self.name = name
+        self.outdir = outdir
+        self.packed = packed
+        self.resources = resources
+        self.sum_outdir = sum_outdir
+        self.parse_kwargs = parse_kwargs
+        self.rules_path = rules_file(name)
+        self.asset_rules = None
+        self.store = None
+
+    def _compile(self):
+        self.rules_signature = _file_signature(self.rules_path)
+        self.asset_rules = AssetRules(self.name)
+
+    def snapshot(self):
+        #Signature of every watched file, fullpath: (mtime, size)
+        config = self.asset_rules.config
+        files = {}
+        for root in self.resources.root:
+            if self.parse_kwargs.get('archives'):
+                catfiles = CatalogIndex.catalog_files(root)
+                paths = catfiles + [os.path.splitext(f)[0] + '.dat' for f in catfiles]
+            else:
+                assetdir = os.path.join(root, config['asset_path'])
+                try:
+                    names = os.listdir(assetdir)
+                except OSError:
+                    names = []
+                paths = [os.path.join(assetdir, n) for n in names 
+                         if os.path.splitext(n)[1] == '.xml' and re.search(config['file_pattern'], n)]
+            files.update({p:_file_signature(p) for p in paths})
+        return(files)
+
+    def run(self):
+        #Full parse, transform and export, returns the export report
+        
+        if self.asset_rules is None:
+            self._compile()
+        if self.parse_kwargs.get('archives'):
+            close_catalogs()
+            
+        self.files = self.snapshot()
+        self.store = self.asset_rules.load(self.resources, **self.parse_kwargs)
+        self.chains = self._list()[2]
+        return(self._transform_all())
+
+    def _list(self):
+        #(assets, filelist, chains) of the current files, chains maps the asset fullpath to the
+        #paths it is read from
+        config = self.asset_rules.config
+        files, filelist = find_resource_files(self.resources, config['asset_path'], config['file_pattern'],
+                                              archives=self.parse_kwargs.get('archives', False))
+        if self.parse_kwargs.get('overlay'):
+            files, filelist = overlay_chains(files, filelist)
+            members = [tuple(ParseCache.key(m) for m in chain) for chain in filelist]
+        else:
+            members = [(ParseCache.key(f),) for f in filelist]
+        return(files, filelist, dict(zip(files.fullpath, members)))
+
+    def _transform_all(self):
+        with stage('transform'):
+            self.modified, self.modified_cols = self.asset_rules.transform(self.store)
+        self.aliases = self.store.aliases(self.asset_rules.config['taglist'])
+        return(export_modified(self.modified, self.modified_cols, self.name, self.resources, 
+                               self.outdir, self.sum_outdir, packed=self.packed))
+
+    def poll(self):
+        #Applies any changes since the last look, returns the export report (None if none)
+        #with the number of changed files and transformed assets added
+        
+        if _file_signature(self.rules_path) != self.rules_signature:
+            previous = self.asset_rules.config
+            self._compile()
+            reload = any(previous.get(k) != self.asset_rules.config.get(k) for k in self.LOAD_KEYS)
+            report = self.run() if reload else self._transform_all()
+            report.update(files=0 if not reload else len(self.files), assets=len(self.store), rules=True)
+            return(report)
+
+        files = self.snapshot()
+        if files == self.files:
+            return(None)
+        if self.parse_kwargs.get('archives'):
+            report = self.run()
+            report.update(files=len(files), assets=len(self.store))
+            return(report)
+
+        changed = [p for p, signature in files.items() if self.files.get(p) != signature]
+        removed = [p for p in self.files if p not in files]
+        self.files = files
+        return(self.update(changed, removed))
+
+    def update(self, changed, removed):
+        #Reparses the assets of the changed files, drops the vanished ones and transforms/exports
+        #again the partitions they belong to
+        
+        config = self.asset_rules.config
+        kwargs = dict(self.parse_kwargs)
+        kwargs.pop('archives', None)
+        if len(changed) <= self.SERIAL_FILES:
+            kwargs['executor'] = 'serial'
+
+        files, filelist, chains = self._list()
+        touched = set(ParseCache.key(p) for p in changed + removed)
+        pick = np.array([self.chains.get(path) != members or not touched.isdisjoint(members)
+                         for path, members in chains.items()], dtype=bool)
+        gone = [path for path in self.chains if path not in chains]
+        self.chains = chains
+
+        parsed = parse_files([f for f, p in zip(filelist, pick) if p], config['taglist'], **kwargs)
+        changes = AttributeStore.from_parsed(files[pick], parsed).add_metadata(config['name_pattern'], config['name_groups'])
+
+        before = self.store.assets[self.store.assets.fullpath.isin(list(changes.assets.fullpath) + gone)]
+        self.store = self.store.update(changes, key='fullpath', removed=gone)
+        
+        keys = self.asset_rules.partition_keys
+        if not keys or self.store.aliases(config['taglist']) != self.aliases:
+            report = self._transform_all()
+            report.update(files=len(changed) + len(removed), assets=len(self.store))
+            return(report)
+
+        #every partition (e.g. size and mk) holding a changed asset before or after the change
+        touched = pd.concat([before[keys], changes.assets[keys]]).astype(object)
+        partitions = set(pd.MultiIndex.from_frame(touched))
+        stale = _key_mask(self.modified, keys, partitions)
+        subset = self.store.select(_key_mask(self.store.assets, keys, partitions))
+
+        if len(subset):
+            with stage('transform'):
+                rows, _ = self.asset_rules.transform(subset)
+        else:
+            rows = self.modified.iloc[:0].copy()
+        
+        report = export_modified(rows, self.modified_cols, self.name, self.resources, self.outdir, 
+                                 self.sum_outdir, scope=self.modified.loc[stale, 'fullpath_final'], packed=self.packed)
+        self.modified = pd.concat([self.modified[~stale], rows], ignore_index=True)
+        report.update(files=len(changed) + len(removed), assets=len(subset))
+
+        return(report)
+
+#------------------------------------------------------------------------------
+
+def watch_pipeline(config, interval=1.0, gui=False):
+    #Runs the pipeline, then keeps the diff exports up to date until interrupted (Ctrl+C)
+    #
+    #config: dict with the DEFAULT_CONFIG keys
+    #interval: seconds between looks at the resource files and rule configs
+    #gui: allow Tk dialogs for missing roots
+    #
+    #Validation reports are not made while watching, the modified_<name>.csv summaries are
+    #written once the watch stops.  Returns dict of asset name: AssetWatch
+
+    sum_outdir, resources, parse_kwargs = _pipeline_inputs(config, gui)
+
+    watches = {}
+    for name, outdir in config['assets'].items():
+        watches[name] = AssetWatch(name, outdir, resources, sum_outdir, packed=config.get('packed', False), **parse_kwargs)
+        report = watches[name].run()
+        print(asset_label(name) + ' diffs: {written} written, {skipped} unchanged, {removed} removed'.format(**report))
+
+    print('Watching for changes every ' + str(interval) + ' s, Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(interval)
+            for name, watch in watches.items():
+                started = time.perf_counter()
+                report = watch.poll()
+                if report is not None:
+                    print(asset_label(name) + ' updated in {:.3f} s: '.format(time.perf_counter() - started) + 
+                          '{files} files changed, {assets} assets transformed, '
+                          'diffs: {written} written, {skipped} unchanged, {removed} removed'.format(**report))
+    except KeyboardInterrupt:
+        pass
+
+    for name, watch in watches.items():
+        write_summary_table(watch.modified, summary_table_path(sum_outdir, name, config.get('summary_format', 'csv')))
+
+    return(watches)
+
+#------------------------------------------------------------------------------
+
+def main(argv=None):
+    #Command line entry point, run with --help for the options
+    
+    parser = argparse.ArgumentParser(description='Bulk modify X4:Foundations asset files into diff mods.')
+    parser.add_argument('-c', '--config', help='JSON config file, keys override DEFAULT_CONFIG')
+    parser.add_argument('--no-gui', action='store_true', 
+                        help='headless run: no Tk dialogs (missing roots are an error) and no browser reports')
+    parser.add_argument('--no-report', action='store_true', help='skip the validation reports')
+    parser.add_argument('--assets', nargs='+', help='only modify these asset classes from the config')
+    parser.add_argument('--summary-dir', help='summary output directory')
+    parser.add_argument('--loose', action='store_true', 
+                        help='write loose diff xml files instead of ext_01.cat/.dat archives (for debugging)')
+    parser.add_argument('--summary-format', choices=['csv', 'parquet', 'html'],
+                        help='format of the modified_<asset> summary tables (parquet needs pyarrow)')
+    parser.add_argument('--profile', action='store_true', 
+                        help='also trace allocations and cProfile the run into the run report (slower)')
+    parser.add_argument('--scenarios', metavar='FILE',
+                        help='JSON file of scenario name: params overrides, every scenario gets its own output tree')
+    parser.add_argument('--watch', nargs='?', type=float, const=1.0, metavar='SECONDS',
+                        help='keep running and update the diffs of changed files and rules (polls every SECONDS, default 1)')
+    args = parser.parse_args(argv)
+
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    if args.config:
+        with open(args.config, 'r') as infile:
+            user_config = json.load(infile)
+        for key, value in user_config.items():
+            if key == 'parse':
+                config['parse'].update(value)
+            else:
+                config[key] = value
+    
+    if args.no_report:
+        config['report'] = False
+    if args.summary_dir:
+        config['summary_dir'] = args.summary_dir
+    if args.summary_format:
+        config['summary_format'] = args.summary_format
+    if args.profile:
+        config['profile'] = True
+    if args.loose:
+        config['packed'] = False
+    if args.scenarios:
+        with open(args.scenarios, 'r') as infile:
+            config['scenarios'] = json.load(infile)
+    if args.assets:
+        missing = [a for a in args.assets if a not in config['assets']]
+        if missing:
+            parser.error('asset classes not in the config: ' + ', '.join(missing))
+        config['assets'] = {a:config['assets'][a] for a in args.assets}
+
+    if args.watch is not None:
+        if config.get('scenarios'):
+            parser.error('--watch keeps a single run up to date, it does not take scenarios')
+        watch_pipeline(config, interval=args.watch, gui=not args.no_gui)
+    else:
+        run_pipeline(config, gui=not args.no_gui)
+    
+    return(0)
+
+#==============================================================================
+
+if __name__ == "__main__":
+    sys.exit(main())